@@ -3,36 +3,57 @@
 # ====================================
 import os
 import urllib.parse
-import openai
-from openai import AzureOpenAI
-from fastapi import FastAPI, Request, HTTPException, Depends, APIRouter  # ← 追加　　Githubに追加！　HTTPException, Depends, APIRouter
+import asyncio
+import anyio.to_thread
+import sys
+import importlib
+import httpx
+from fastapi import FastAPI, Request, HTTPException, Depends, APIRouter, BackgroundTasks  # ← 追加　　Githubに追加！　HTTPException, Depends, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-import instaloader
 import re
-from collections import defaultdict
-from instaloader import Instaloader, Profile
-from typing import List
+from collections import defaultdict, deque
+from typing import List, Optional
 import csv
-import tempfile
-from azure.storage.blob import BlobServiceClient
-import requests
+import io
+import base64
+import threading
+from contextlib import AsyncExitStack, contextmanager, asynccontextmanager
+import bisect
+import numpy as np
+from typing import TYPE_CHECKING
+# openai / instaloader / azure は重いので、初回利用時（またはウォームアップ時）に import する
+if TYPE_CHECKING:
+    from openai import AsyncAzureOpenAI
+    from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from urllib.parse import urlparse
 import uuid
-import mysql.connector
 from datetime import datetime
 
-from fastapi.responses import FileResponse  # 2025.04.22 15時　追加✅ Githubに追加！
 import pymysql # 2025.04.22 15時　追加✅ Githubに追加！
 
 # Line26～121 追加✅ Githubに追加！
 from typing import Dict  # ← 追加  Githubに追加！
 import bcrypt  # ← 追加  Githubに追加！ # パスワードハッシュ化のため追加
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime  # ← DateTime を追加
+from sqlalchemy import create_engine, event, inspect, insert, select, text, and_, or_, Column, Integer, String, ForeignKey, DateTime, Text, Float, Index, UniqueConstraint, func  # ← DateTime を追加
 from sqlalchemy.ext.declarative import declarative_base # ← 追加  Githubに追加！
-from sqlalchemy.orm import sessionmaker, relationship, Session  # ← Session を追加
+from sqlalchemy.orm import sessionmaker, relationship, joinedload, Session  # ← Session を追加
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 import json # ← 追加  Githubに追加！
+import hashlib
+import hmac
+import secrets
+import random
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from starlette.concurrency import run_in_threadpool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from passlib.context import CryptContext # ← 追加  Githubに追加！ # パスワードハッシュ化のため追加
 from dotenv import load_dotenv # ← 追加  Githubに追加！
 load_dotenv() # ← 追加  Githubに追加！
@@ -42,29 +63,97 @@ load_dotenv() # ← 追加  Githubに追加！
 # =======================
 MYSQL_DB_HOST = os.getenv("MYSQL_DB_HOST")
 MYSQL_DB_USER = os.getenv("MYSQL_DB_USER")
-MYSQL_DB_PASSWORD = urllib.parse.quote_plus(os.getenv("MYSQL_DB_PASSWORD"))  # URLエンコード
+MYSQL_DB_PASSWORD = urllib.parse.quote_plus(os.getenv("MYSQL_DB_PASSWORD", ""))  # URLエンコード
 MYSQL_DB_NAME = os.getenv("MYSQL_DB_NAME")
 MYSQL_DB_PORT = os.getenv("MYSQL_DB_PORT", "3306")
 PORT = int(os.getenv("PORT", 8080))  # デフォルト 8080
 
-print("✅ .env 読み込みチェック:")
-print("MYSQL_DB_HOST:", MYSQL_DB_HOST)
-print("MYSQL_DB_USER:", MYSQL_DB_USER)
-print("MYSQL_DB_PASSWORD:", MYSQL_DB_PASSWORD)
-print("MYSQL_DB_NAME:", MYSQL_DB_NAME)
-print("MYSQL_DB_PORT:", MYSQL_DB_PORT)
-
 # SSL 証明書のパス
 SSL_CERT_PATH = os.path.join(os.path.dirname(__file__), "DigiCertGlobalRootCA.crt.pem")
 
 # MySQL接続情報（SSL 証明書を適用）
-SQLALCHEMY_DATABASE_URL = f"mysql+pymysql://{MYSQL_DB_USER}:{MYSQL_DB_PASSWORD}@{MYSQL_DB_HOST}:{MYSQL_DB_PORT}/{MYSQL_DB_NAME}"
+# DATABASE_URL を指定すると別の DB を使う（ベンチマーク用の SQLite など）
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL") or f"mysql+pymysql://{MYSQL_DB_USER}:{MYSQL_DB_PASSWORD}@{MYSQL_DB_HOST}:{MYSQL_DB_PORT}/{MYSQL_DB_NAME}"
+IS_MYSQL = SQLALCHEMY_DATABASE_URL.startswith("mysql")
+
+# コネクションプール設定（Azure MySQL はアイドル接続を切断するため、再利用前に ping して定期的に張り直す）
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # 空き接続待ちの上限（秒）
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # 秒。サーバー側 wait_timeout より短くする
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 10))  # 秒
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float):
+        self.checkouts += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+pool_stats = PoolStats()
+
+class TimedQueuePool(QueuePool):
+    # 接続の取り出しにかかった時間（空き待ち・新規接続を含む）を記録する
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record_wait(time.perf_counter() - started)
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
-    connect_args={"ssl": {"ssl_ca": SSL_CERT_PATH}}  # 👈 SSL 証明書を適用
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={
+        "ssl": {"ssl_ca": SSL_CERT_PATH},  # 👈 SSL 証明書を適用
+        "connect_timeout": DB_CONNECT_TIMEOUT,
+    } if IS_MYSQL else {"check_same_thread": False}
 )
 
+@event.listens_for(engine, "connect")
+def _count_connect(dbapi_connection, connection_record):
+    pool_stats.connects += 1
+
+@event.listens_for(engine, "invalidate")
+def _count_invalidate(dbapi_connection, connection_record, exception):
+    pool_stats.invalidations += 1
+
+def db_pool_metrics() -> dict:
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checkouts": pool_stats.checkouts,
+        "connects": pool_stats.connects,
+        "invalidations": pool_stats.invalidations,
+        "checkout_wait_avg_ms": round(pool_stats.wait_total / pool_stats.checkouts * 1000, 3) if pool_stats.checkouts else 0.0,
+        "checkout_wait_max_ms": round(pool_stats.wait_max * 1000, 3),
+    }
+
+def upsert_statement(table, values, keys: list, update):
+    # 一意キーが重複したら update(新しい行) の列で更新する 1 文の upsert
+    # 本番の MySQL は ON DUPLICATE KEY UPDATE、DATABASE_URL で切り替えた SQLite は ON CONFLICT DO UPDATE
+    if IS_MYSQL:
+        stmt = mysql_insert(table).values(values)
+        return stmt.on_duplicate_key_update(**update(stmt.inserted))
+    stmt = sqlite_insert(table).values(values)
+    return stmt.on_conflict_do_update(index_elements=keys, set_=update(stmt.excluded))
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -93,14 +182,24 @@ class Question(Base):
 
 class Questionnaire(Base):
     __tablename__ = "questionnaires"
+    __table_args__ = (
+        # 店舗別・ユーザー別の新しい順一覧（キーセットページング）用。InnoDB では末尾に主キー id が暗黙に付く
+        Index("ix_questionnaires_store_created", "store_id", "created_at"),
+        Index("ix_questionnaires_user_created", "user_id", "created_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     store_id = Column(Integer, ForeignKey("stores.id"))
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
+    # 一覧では joinedload で一緒に読む。うっかり遅延ロード（N+1）したら例外にする
+    answers = relationship("Answer", order_by="Answer.question_key", lazy="raise")
 
 class Answer(Base):  #✅追加 再々更新！
     __tablename__ = "answers"
+    __table_args__ = (
+        Index("ix_answers_questionnaire_key", "questionnaire_id", "question_key"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     questionnaire_id = Column(Integer, ForeignKey("questionnaires.id"))
     question_key = Column(String(50))  # 例: "0-1"
@@ -110,6 +209,12 @@ class Answer(Base):  #✅追加 再々更新！
 
 class DiagnosisAnswer(Base): #✅追加
     __tablename__ = "diagnosis_answers"
+    __table_args__ = (
+        # 一括 upsert（ON DUPLICATE KEY UPDATE）の衝突キー
+        UniqueConstraint("user_id", "store_id", "question_key", name="uq_diagnosis_answers_user_store_key"),
+        # 店舗ごとの最新回答をテーブル本体に触れずに読むためのカバリングインデックス
+        Index("ix_diagnosis_answers_store_latest", "store_id", "question_key", "created_at", "answer"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     store_id = Column(Integer, ForeignKey("stores.id"))
@@ -117,16 +222,170 @@ class DiagnosisAnswer(Base): #✅追加
     answer = Column(String(255))
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class AnalysisCacheEntry(Base):  # 経営分析結果の共有キャッシュ
+    __tablename__ = "analysis_cache"
+    cache_key = Column(String(64), primary_key=True)  # sha256 hex
+    result = Column(Text)
+    expires_at = Column(DateTime, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class InstagramPost(Base):  # shortcode ごとの取り込み済み投稿（画像 Blob とメタデータのキャッシュ）
+    __tablename__ = "instagram_posts"
+    shortcode = Column(String(64), primary_key=True)
+    blob_name = Column(String(255))
+    image_url = Column(String(512))
+    content_hash = Column(String(64), index=True)  # 画像本体の sha256
+    caption = Column(Text)
+    likes = Column(Integer)
+    comments = Column(Integer)
+    owner_username = Column(String(100))
+    owner_followers = Column(Integer)
+    variants = Column(Text)  # サイズ別画像の JSON（{"thumb": {"webp": URL, "jpeg": URL, "width": .., "height": ..}, ...}）
+    fetched_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class CampaignPost(Base):  # キャンペーンに登録された投稿ごとの指標
+    __tablename__ = "campaign_posts"
+    __table_args__ = (
+        UniqueConstraint("campaign_id", "shortcode", name="uq_campaign_posts_campaign_shortcode"),
+        Index("ix_campaign_posts_shortcode", "shortcode"),
+    )
+    id = Column(Integer, primary_key=True, index=True)
+    campaign_id = Column(Integer, nullable=False)
+    shortcode = Column(String(64), nullable=False)
+    username = Column(String(100))
+    likes = Column(Integer, default=0)
+    comments = Column(Integer, default=0)
+    engagement = Column(Float, default=0.0)  # (いいね + コメント) / フォロワー数 * 100
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime)
+
+class CampaignUserRollup(Base):  # キャンペーン × 投稿者 の集計（投稿の登録・更新時に差分で更新）
+    __tablename__ = "campaign_user_rollups"
+    campaign_id = Column(Integer, primary_key=True)
+    username = Column(String(100), primary_key=True)
+    post_count = Column(Integer, default=0)
+    likes = Column(Integer, default=0)
+    comments = Column(Integer, default=0)
+    engagement_sum = Column(Float, default=0.0)
+    updated_at = Column(DateTime)
+
+class GeneratedImage(Base):  # プロンプトごとの生成画像（同じプロンプトの再生成を防ぐ）
+    __tablename__ = "generated_images"
+    prompt_hash = Column(String(64), primary_key=True)  # sha256 hex
+    prompt = Column(Text)
+    blob_name = Column(String(255))
+    image_url = Column(String(512))
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ImageJob(Base):  # 画像生成ジョブの状態（ポーリングがどのワーカーに届いても答えられるよう DB に置く）
+    __tablename__ = "image_jobs"
+    __table_args__ = (
+        # 生成中だけ active_hash に prompt_hash を入れ、完了で NULL に戻す。同じプロンプトの同時生成をワーカーをまたいで 1 件に絞る
+        UniqueConstraint("active_hash", name="uq_image_jobs_active_hash"),
+    )
+    job_id = Column(String(32), primary_key=True)
+    prompt_hash = Column(String(64), nullable=False)
+    active_hash = Column(String(64))
+    status = Column(String(20), nullable=False)  # queued / running / done / error
+    image_url = Column(String(512))
+    error = Column(Text)
+    cached = Column(Integer, default=0)  # 保存済みの画像を返した場合 1
+    created_at = Column(Float, nullable=False)  # UNIX 時刻（秒）
+    finished_at = Column(Float, index=True)
+
+class InstagramJob(Base):  # SNS投稿取り込みジョブの状態（ポーリングがどのワーカーに届いても答えられるよう DB に置く）
+    __tablename__ = "instagram_jobs"
+    job_id = Column(String(32), primary_key=True)
+    url = Column(Text)
+    status = Column(String(20), nullable=False)  # queued / running / done / error / rejected
+    result = Column(Text)  # 取り込み結果の JSON
+    error = Column(Text)
+    created_at = Column(Float, nullable=False)  # UNIX 時刻（秒）
+    finished_at = Column(Float, index=True)
+
+class RateLimitBucket(Base):  # レート制限のトークンバケツ（複数インスタンスで共有する場合）
+    __tablename__ = "rate_limit_buckets"
+    bucket_key = Column(String(191), primary_key=True)  # "ポリシー:user:ID" / "ポリシー:ip:アドレス"
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)  # UNIX 時刻（秒）
+
 # =============================
 # DB初期化
 # =============================
-Base.metadata.create_all(bind=engine)
+# import 時には DB に接続しない。テーブル作成は gunicorn 起動時にマスターで 1 回実行する
+# （gunicorn.conf.py の on_starting、MIGRATE_ON_START=false で無効）。手動で流す場合:
+#   python app.py migrate
+def migrate_database():
+    Base.metadata.create_all(bind=engine)
+    # create_all は既存テーブルにインデックスを足さないので、後から追加したものはここで作る
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        # 後から追加した NULL 可の列も同様に足す
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns and column.nullable and not column.primary_key:
+                print(f"🔧 列追加: {table.name}.{column.name}")
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=engine.dialect)}"))
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                print(f"🔧 インデックス作成: {table.name}.{index.name}")
+                index.create(bind=engine)
+        add_unique_constraints(table, inspector)
+
+def add_unique_constraints(table, inspector):
+    # create_all は既存テーブルに一意制約を足さない。制約が無い間に溜まった重複行を消してから一意インデックスを作る
+    # （upsert の ON DUPLICATE KEY / ON CONFLICT は一意インデックスでも効く）
+    unique_columns = [set(c["column_names"]) for c in inspector.get_unique_constraints(table.name)]
+    unique_columns += [set(i["column_names"]) for i in inspector.get_indexes(table.name) if i.get("unique")]
+    for constraint in table.constraints:
+        if not isinstance(constraint, UniqueConstraint):
+            continue
+        columns = [column.name for column in constraint.columns]
+        if set(columns) in unique_columns:
+            continue
+        column_list = ", ".join(columns)
+        with engine.begin() as conn:
+            if "id" in table.c:
+                # 同じキーの行は id が最大（最後に追加された）ものを残す。MySQL は同じテーブルを直接副問い合わせできないので派生表を挟む
+                deleted = conn.execute(text(
+                    f"DELETE FROM {table.name} WHERE id NOT IN "
+                    f"(SELECT id FROM (SELECT MAX(id) AS id FROM {table.name} GROUP BY {column_list}) AS keep_rows)"
+                )).rowcount
+                if deleted:
+                    print(f"🔧 重複行削除: {table.name} {deleted} 行")
+            print(f"🔧 一意制約追加: {table.name}.{constraint.name}")
+            conn.execute(text(f"CREATE UNIQUE INDEX {constraint.name} ON {table.name} ({column_list})"))
 # Line26～121 追加✅ Githubに追加！
 
 # ================================
 # 🚀 FastAPI アプリケーション作成
 # ================================
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 起動時は軽い初期化だけ行い、外部サービスの接続確立はバックグラウンドで並行して温める
+    setup_opentelemetry()
+    if THREADPOOL_WORKERS:
+        # run_in_threadpool（DB・Instaloader 呼び出し）の同時実行数。既定は 40
+        anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_WORKERS
+    await start_instagram_job_workers()
+    start_warm_up()
+    yield
+    # ここに来るのは、サーバーが新規接続を止めて実行中のリクエスト（ストリーム含む）を流し終えた後
+    if active_streams:
+        print(f"⚠️ 終了時に {active_streams} 件のストリームが残っていました")
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+    await stop_instagram_job_workers()
+    await cancel_image_jobs()
+    await close_openai_clients()
+    await close_blob_clients()
+    shutdown_password_executor()
+    shutdown_image_executor()
+
+app = FastAPI(lifespan=lifespan)
 
 # Line128～132 追加✅ Githubに追加！
 origins = [
@@ -144,6 +403,201 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+# ==================================
+# 📊 レイテンシ計測 / トレーシング
+# ==================================
+# ルートごとのレイテンシと、上流呼び出し（OpenAI・Instagram・Blob・MySQL）ごとのスパンを
+# 固定バケットのヒストグラムに記録し、/metrics で Prometheus 形式で公開する。
+# OTEL_EXPORTER_OTLP_ENDPOINT が設定されていれば OpenTelemetry にもスパンを送る。
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class Histogram:
+    __slots__ = ("buckets", "total", "count")
+
+    def __init__(self):
+        self.buckets = [0] * (len(METRIC_BUCKETS) + 1)  # 最後は +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()  # DB イベントはスレッドプールからも届く
+        self.request_latency = defaultdict(Histogram)  # (method, route) -> Histogram（レスポンスヘッダー送信まで）
+        self.response_duration = defaultdict(Histogram)  # (method, route) -> Histogram（本体の送信完了まで）
+        self.request_total = defaultdict(int)  # (method, route, status) -> 件数
+        self.upstream_latency = defaultdict(Histogram)  # upstream -> Histogram
+        self.upstream_errors = defaultdict(int)  # upstream -> 件数
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, total_seconds: float):
+        with self._lock:
+            self.request_latency[(method, route)].observe(seconds)
+            self.response_duration[(method, route)].observe(total_seconds)
+            self.request_total[(method, route, status)] += 1
+
+    def observe_upstream(self, upstream: str, seconds: float, error: bool = False):
+        with self._lock:
+            self.upstream_latency[upstream].observe(seconds)
+            if error:
+                self.upstream_errors[upstream] += 1
+
+metrics = MetricsRegistry()
+otel_tracer = None
+
+def setup_opentelemetry():
+    global otel_tracer
+    if not os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except ImportError:
+        print("⚠️ opentelemetry-sdk / opentelemetry-exporter-otlp が未インストールのため OTLP 出力は無効です")
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "richconnections-back")}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    otel_tracer = trace.get_tracer("richconnections-back")
+
+@contextmanager
+def trace_span(upstream: str):
+    # 同期処理・async 処理のどちらでも `with trace_span("openai_completion"):` で囲める
+    started = time.perf_counter()
+    span = otel_tracer.start_span(upstream) if otel_tracer is not None else None
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        metrics.observe_upstream(upstream, time.perf_counter() - started, error)
+        if span is not None:
+            span.end()
+
+class MetricsMiddleware:
+    # BaseHTTPMiddleware を使わない素の ASGI ミドルウェア（ストリーミングを妨げず、オーバーヘッドも小さい）
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+        headers_sent = [None]  # レスポンスヘッダーを送った時点（SSE などは本体の完了よりずっと早い）
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                headers_sent[0] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # パスそのものではなくルートのテンプレートで集計する（ラベル数の爆発を防ぐ）
+            route = scope.get("route")
+            finished = time.perf_counter()
+            metrics.observe_request(
+                scope["method"], getattr(route, "path", "unmatched"), status[0],
+                (headers_sent[0] or finished) - started, finished - started,
+            )
+
+app.add_middleware(MetricsMiddleware)
+
+@event.listens_for(engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    metrics.observe_upstream("mysql_query", time.perf_counter() - started)
+
+@event.listens_for(engine, "handle_error")
+def _record_query_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        started = connection.info["query_started"].pop()
+        metrics.observe_upstream("mysql_query", time.perf_counter() - started, error=True)
+
+def _prometheus_labels(**labels) -> str:
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+def _prometheus_histogram(lines: list, name: str, histogram: Histogram, **labels):
+    cumulative = 0
+    for bound, count in zip(METRIC_BUCKETS + (float("inf"),), histogram.buckets):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{name}_bucket{_prometheus_labels(**labels, le=le)} {cumulative}")
+    lines.append(f"{name}_sum{_prometheus_labels(**labels)} {histogram.total}")
+    lines.append(f"{name}_count{_prometheus_labels(**labels)} {histogram.count}")
+
+def render_prometheus_metrics() -> str:
+    lines = []
+    with metrics._lock:
+        lines.append("# HELP http_request_duration_seconds HTTP リクエストの処理時間（レスポンスヘッダー送信まで）")
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        for (method, route), histogram in sorted(metrics.request_latency.items()):
+            _prometheus_histogram(lines, "http_request_duration_seconds", histogram, method=method, route=route)
+        lines.append("# HELP http_response_duration_seconds レスポンス本体の送信完了までの時間（ストリーミング応答ではストリームの長さ）")
+        lines.append("# TYPE http_response_duration_seconds histogram")
+        for (method, route), histogram in sorted(metrics.response_duration.items()):
+            _prometheus_histogram(lines, "http_response_duration_seconds", histogram, method=method, route=route)
+        lines.append("# TYPE http_requests_total counter")
+        for (method, route, status), count in sorted(metrics.request_total.items()):
+            lines.append(f"http_requests_total{_prometheus_labels(method=method, route=route, status=status)} {count}")
+        lines.append("# HELP upstream_call_duration_seconds 上流呼び出し（OpenAI / Instagram / Blob / MySQL）の所要時間")
+        lines.append("# TYPE upstream_call_duration_seconds histogram")
+        for upstream, histogram in sorted(metrics.upstream_latency.items()):
+            _prometheus_histogram(lines, "upstream_call_duration_seconds", histogram, upstream=upstream)
+        lines.append("# TYPE upstream_call_errors_total counter")
+        for upstream, count in sorted(metrics.upstream_errors.items()):
+            lines.append(f"upstream_call_errors_total{_prometheus_labels(upstream=upstream)} {count}")
+
+    pool = db_pool_metrics()
+    lines.append("# TYPE db_pool_checked_out gauge")
+    lines.append(f"db_pool_checked_out {pool['checked_out']}")
+    lines.append("# TYPE db_pool_idle gauge")
+    lines.append(f"db_pool_idle {pool['idle']}")
+    lines.append("# TYPE db_pool_overflow gauge")
+    lines.append(f"db_pool_overflow {pool['overflow']}")
+    lines.append("# TYPE db_pool_checkouts_total counter")
+    lines.append(f"db_pool_checkouts_total {pool_stats.checkouts}")
+    lines.append("# TYPE db_pool_checkout_wait_seconds_total counter")
+    lines.append(f"db_pool_checkout_wait_seconds_total {pool_stats.wait_total}")
+    lines.append("# TYPE http_active_streams gauge")
+    lines.append(f"http_active_streams {active_streams}")
+    return "\n".join(lines) + "\n"
+
+# ストリーミング応答（SSE / NDJSON / CSV）の実行中件数。シャットダウン時はこれが 0 になるまで待つ
+THREADPOOL_WORKERS = int(os.getenv("THREADPOOL_WORKERS", 0))  # 0 は既定値のまま
+active_streams = 0
+
+class TrackedStreamingResponse(StreamingResponse):
+    async def __call__(self, scope, receive, send):
+        global active_streams
+        active_streams += 1
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            active_streams -= 1
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(render_prometheus_metrics(), media_type="text/plain; version=0.0.4")
+
 # Line145～155 追加✅ Githubに追加！
 # =============================
 # DBセッションを取得する依存関数   
@@ -156,46 +610,206 @@ def get_db():
         db.close()
 # Line145～155 追加✅ Githubに追加！
 
+# =============================
+# 📈 DB コネクションプールのメトリクス
+# =============================
+@app.get("/api/metrics/db-pool")
+async def db_pool_status():
+    return db_pool_metrics()
+
+# =============================
+# 🚦 レート制限 / 同一リクエストの集約
+# =============================
+# 高コストなエンドポイントはユーザー（未ログインなら IP）ごとのトークンバケツで制限する。
+# バケツはプロセス内（既定）か MySQL（複数インスタンスで共有）に置く。
+# 同じ内容の同時リクエストは 1 回の上流呼び出しにまとめ、結果を全員に返す。
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")  # memory / mysql
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 10000))  # メモリ上に保持するバケツ数
+# X-Forwarded-For を信用するのはプロキシ配下のときだけ（App Service では WEBSITE_SITE_NAME が設定される）
+RATE_LIMIT_TRUST_FORWARDED = os.getenv(
+    "RATE_LIMIT_TRUST_FORWARDED", "true" if os.getenv("WEBSITE_SITE_NAME") else "false"
+).lower() == "true"
+# 前段にある信用できるプロキシの段数。各プロキシは末尾に接続元を追記するので、末尾から数えてこの位置を使う
+RATE_LIMIT_TRUSTED_HOPS = max(1, int(os.getenv("RATE_LIMIT_TRUSTED_HOPS", 1)))
+
+def rate_policy(env: str, default: str) -> tuple:
+    # "回数/秒数"（例: "20/60" は 60 秒で 20 回、バーストも 20 回まで）
+    count, seconds = os.getenv(env, default).split("/")
+    return int(count), float(seconds)
+
+RATE_LIMIT_POLICIES = {
+    "analyze": rate_policy("RATE_LIMIT_ANALYZE", "20/60"),
+    "analyze_batch": rate_policy("RATE_LIMIT_ANALYZE_BATCH", "3/60"),
+    "image": rate_policy("RATE_LIMIT_IMAGE", "5/60"),
+    "instagram": rate_policy("RATE_LIMIT_INSTAGRAM", "30/60"),
+    "export": rate_policy("RATE_LIMIT_EXPORT", "3/300"),
+}
+
+class RateLimitExceeded(Exception):
+    def __init__(self, policy: str, retry_after: float):
+        super().__init__(f"リクエストが多すぎます。{int(retry_after) + 1} 秒後に再試行してください")
+        self.policy = policy
+        self.retry_after = retry_after
+
+class MemoryBucketStore:
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated_at)
+
+    async def take(self, key: str, capacity: int, rate: float, cost: int) -> float:
+        # 取れたら 0、取れなければ待つべき秒数を返す
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(key, (float(capacity), now))
+        tokens = min(float(capacity), tokens + (now - updated_at) * rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)  # しばらく来ていない利用者から捨てる（満タン扱いに戻るだけ）
+        return wait
+
+class MySQLBucketStore:
+    def _take(self, key: str, capacity: int, rate: float, cost: int) -> float:
+        now = time.time()
+        table = RateLimitBucket.__table__
+        with engine.begin() as conn:
+            # 初回だけ満タンの行を作り、以降は行ロックを取って読み書きする
+            conn.execute(
+                insert(table).prefix_with("IGNORE" if IS_MYSQL else "OR IGNORE")
+                .values(bucket_key=key, tokens=float(capacity), updated_at=now)
+            )
+            tokens, updated_at = conn.execute(
+                select(table.c.tokens, table.c.updated_at).where(table.c.bucket_key == key).with_for_update()
+            ).one()
+            tokens = min(float(capacity), tokens + max(0.0, now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            conn.execute(table.update().where(table.c.bucket_key == key).values(tokens=tokens, updated_at=now))
+        return wait
+
+    async def take(self, key: str, capacity: int, rate: float, cost: int) -> float:
+        try:
+            return await run_in_threadpool(self._take, key, capacity, rate, cost)
+        except Exception as e:
+            # 共有ストアの障害でサービス全体を止めない
+            print("⚠️ レート制限ストアエラー（制限せず通します）:", str(e))
+            return 0.0
+
+rate_limit_store = MySQLBucketStore() if RATE_LIMIT_STORE == "mysql" else MemoryBucketStore(RATE_LIMIT_MAX_KEYS)
+rate_limit_stats = defaultdict(lambda: {"allowed": 0, "limited": 0})
+
+def rate_limit_identity(request: Request) -> str:
+    user_id = getattr(request.state, "user_id", None)
+    if user_id is None:
+        user_id = token_user_id(request)
+    if user_id is not None:
+        return f"user:{user_id}"
+    host = request.client.host if request.client else "unknown"
+    forwarded = request.headers.get("x-forwarded-for")
+    if RATE_LIMIT_TRUST_FORWARDED and forwarded:
+        # 先頭側はクライアントが自由に書けるので、信用できるプロキシが追記した位置だけを見る
+        hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+        host = hops[-min(RATE_LIMIT_TRUSTED_HOPS, len(hops))] if hops else host
+        if host.count(":") == 1:
+            host = host.split(":")[0]  # App Service は "IP:ポート" で渡してくる
+    return f"ip:{host}"
+
+def rate_limited(policy: str, cost: int = 1):
+    # ルートの dependencies に指定する: dependencies=[Depends(rate_limited("analyze"))]
+    async def check(request: Request):
+        if not RATE_LIMIT_ENABLED:
+            return
+        capacity, seconds = RATE_LIMIT_POLICIES[policy]
+        wait = await rate_limit_store.take(f"{policy}:{rate_limit_identity(request)}", capacity, capacity / seconds, cost)
+        if wait > 0:
+            rate_limit_stats[policy]["limited"] += 1
+            raise RateLimitExceeded(policy, wait)
+        rate_limit_stats[policy]["allowed"] += 1
+    return check
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
+    return JSONResponse(
+        status_code=429,
+        content={"error": str(exc), "policy": exc.policy, "retry_after": round(exc.retry_after, 1)},
+        headers={"Retry-After": str(int(exc.retry_after) + 1)},
+    )
+
+class SingleFlight:
+    # 同じキーの処理が実行中なら、新しく始めずにその結果を待つ
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self.stats = {"leaders": 0, "shared": 0, "cancelled": 0}
+
+    async def do(self, key: str, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["leaders"] += 1
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            self.stats["shared"] += 1
+        self._waiters[key] += 1
+        try:
+            # 呼び出し元が切断しても、相乗りしている他の呼び出し元がいる間は処理を続ける
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+                if self._waiters[key] == 0 and not task.done():
+                    # 待っている人がいなくなったら上流の呼び出し（と予算待ち）も止める
+                    self.stats["cancelled"] += 1
+                    self._forget(key, task)  # 後から来た呼び出し元は取り消し中のタスクに相乗りさせない
+                    task.cancel()
+            raise
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._waiters[key]
+
+request_flights = SingleFlight()
+
+@app.get("/api/rate-limits")
+async def rate_limit_status():
+    return {
+        "enabled": RATE_LIMIT_ENABLED,
+        "store": RATE_LIMIT_STORE,
+        "policies": {name: {"requests": count, "seconds": seconds} for name, (count, seconds) in RATE_LIMIT_POLICIES.items()},
+        "stats": rate_limit_stats,
+        "coalescing": {**request_flights.stats, "inflight": len(request_flights._inflight)},
+    }
+
 # =======================
 # 🔐 Azure 環境変数から取得
 # =======================
-# OpenAI API 関連
-openai.api_type = "azure"
-openai.api_key = os.getenv("OPENAI_API_KEY")
-openai.api_base = os.getenv("OPENAI_API_BASE")
-openai.api_version = os.getenv("OPENAI_API_VERSION")
-model = os.getenv("OPENAI_MODEL")
-
-# Azure Blob Storage 接続
-azure_connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-if not azure_connection_string:
-    raise ValueError("❌ AZURE_STORAGE_CONNECTION_STRING が設定されていません")
-blob_service_client = BlobServiceClient.from_connection_string(azure_connection_string)
+# Azure Blob Storage 接続（クライアントは初回利用時に作成）
 container_name = "instagram-posts"
 
-# MySQL 接続情報
-MYSQL_DB_CONFIG = {
-    "host": os.getenv("MYSQL_DB_HOST"),
-    "port": int(os.getenv("MYSQL_DB_PORT", 3306)),
-    "user": os.getenv("MYSQL_DB_USER"),
-    "password": urllib.parse.quote_plus(os.getenv("MYSQL_DB_PASSWORD")),
-    "database": os.getenv("MYSQL_DB_NAME"),
-    "ssl_ca": os.path.join(os.path.dirname(__file__), "DigiCertGlobalRootCA.crt.pem"),
-    "ssl_verify_cert": True
-}
-
-# ログ出力
-print("✅ OPENAI_BASE:", openai.api_base)
-print("✅ MODEL:", model)
-print("✅ API_VERSION:", openai.api_version)
-print("✅ AZURE_STORAGE:", blob_service_client.account_name)
-print("✅ MySQL HOST:", MYSQL_DB_CONFIG["host"])
-
 # ======================
 # 📦 リクエストモデル定義
 # ======================
 class AnalysisRequest(BaseModel):
     prompt: str
+    no_cache: bool = False  # True の場合は分析キャッシュを使わない
+    max_tokens: Optional[int] = None  # 応答長の上限（未指定ならサーバー側の上限）
+    compact_answers: bool = True  # False の場合は診断回答の羅列を表に圧縮せずそのまま送る
+
+class BatchAnalysisRequest(BaseModel):
+    prompts: List[str] = []
+    store_ids: List[int] = []  # 各店舗の最新の診断回答をプロンプトに展開する
+    instruction: Optional[str] = None  # store_ids の回答の後ろに付ける指示（未指定なら既定の指示）
+    no_cache: bool = False
 
 class ImageRequest(BaseModel):
     analysis_summary: str
@@ -203,6 +817,9 @@ class ImageRequest(BaseModel):
 class PostURL(BaseModel):
     url: str
 
+class InstagramJobRequest(BaseModel):
+    urls: List[str]
+
 class SignupRequest(BaseModel):
     name: str
     email: str
@@ -230,6 +847,17 @@ class QuestionnaireIn(BaseModel):
 
 class SubmitRequest(BaseModel): #✅追加
     answers: Dict # key: "0-0", value: "Yes"など ✅追加
+    user_id: Optional[int] = None
+    store_id: Optional[int] = None
+    questionnaire_id: Optional[int] = None  # 未指定なら questionnaires に新規作成
+    background: bool = False  # True ならバックグラウンドで保存
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class PasswordChangeRequest(BaseModel):
+    current_password: str
+    new_password: str
 
 class DiagnosisRequest(BaseModel):  #✅追加
     user_id: int
@@ -253,16 +881,58 @@ async def hello_world():
 # =============================
 # 🔁 register_user を修正
 # パスワードハッシュ用の設定
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt のコストは環境変数で調整し、コストが変わったハッシュはログイン時に再ハッシュする
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+# ハッシュ計算はイベントループやリクエスト用スレッドプールではなく専用の Executor で行う
+# （複数コアがあればプロセスプール、なければ専用スレッド）
+password_executor = None
+
+def get_password_executor():
+    global password_executor
+    if password_executor is None:
+        if PASSWORD_HASH_WORKERS > 1 and (os.cpu_count() or 1) > 1:
+            password_executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+        else:
+            password_executor = ThreadPoolExecutor(max_workers=max(PASSWORD_HASH_WORKERS, 1), thread_name_prefix="password-hash")
+    return password_executor
+
+def _hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify_password(password: str, hashed: str):
+    # (照合結果, 再ハッシュが必要な場合は新しいハッシュ)
+    return pwd_context.verify_and_update(password, hashed)
+
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_password_executor(), _hash_password, password)
+
+async def verify_password(password: str, hashed: str):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_password_executor(), _verify_password, password, hashed)
+
+def shutdown_password_executor():
+    if password_executor is not None:
+        password_executor.shutdown(wait=False, cancel_futures=True)
 
 @app.post("/api/register")
-def register_user(user: UserIn, db: Session = Depends(get_db)):
-    existing = db.query(User).filter(User.email == user.email).first()
+async def register_user(user: UserIn, db: Session = Depends(get_db)):
+    existing = await run_in_threadpool(lambda: db.query(User).filter(User.email == user.email).first())
     if existing:
         raise HTTPException(status_code=400, detail="すでに登録されたメールアドレスです")
     
     # パスワードをハッシュ化
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = await hash_password(user.password)
 
     new_user = User(
         name=user.name,
@@ -271,228 +941,2418 @@ def register_user(user: UserIn, db: Session = Depends(get_db)):
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow()
     )
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+
+    def save():
+        db.add(new_user)
+        db.commit()
+        db.refresh(new_user)
+
+    await run_in_threadpool(save)
     return {"user_id": new_user.id}
 
 # =============================
 # ログイン　エンドポイント（ハッシュ照合対応）
 # =============================
 @app.post("/api/login")
-def login_user(credentials: dict, db: Session = Depends(get_db)):
+async def login_user(credentials: dict, db: Session = Depends(get_db)):
     email = credentials.get("email")
     password = credentials.get("password")
 
     # 📌 ユーザー検索
-    user = db.query(User).filter(User.email == email).first()
-    if not user:
+    user = await run_in_threadpool(lambda: db.query(User).filter(User.email == email).first())
+    if not user or not password:
         raise HTTPException(status_code=401, detail="メールアドレスまたはパスワードが間違っています")
 
     # 🧠 パスワードハッシュを照合
-    if not pwd_context.verify(password, user.password):
+    verified, new_hash = await verify_password(password, user.password)
+    if not verified:
         raise HTTPException(status_code=401, detail="メールアドレスまたはパスワードが間違っています")
 
+    # 🔁 bcrypt コストが変わっていれば透過的に再ハッシュ
+    if new_hash:
+        def rehash():
+            user.password = new_hash
+            db.commit()
+
+        await run_in_threadpool(rehash)
+
+    # 🎫 署名付きトークンを発行し、以降の認証でDBを引かないようユーザー情報をキャッシュしておく
+    record = auth_user_record(user)
+    auth_user_cache.set(user.id, record)
+    tokens = issue_tokens(user.id, record["fingerprint"])
     return {
         "user_id": user.id,
         "email": user.email,
-        "token": "sample-token"  # ✅ 将来的にJWTなどに置き換える
+        "token": tokens["access_token"],  # 旧フロントエンド互換（access_token と同じ）
+        **tokens,
     }
 
+# =============================
+# 🎫 アクセストークン（HS256 JWT）/ ログインユーザーの解決
+# =============================
+# トークンは署名と有効期限だけで検証でき、ユーザー情報はプロセス内の LRU（TTL 付き）から引くので、
+# 認証付きエンドポイントでは bcrypt も DB アクセスも発生しない。
+# パスワードを変更するとトークン内の指紋（pwv）が合わなくなり、変更前に発行したトークンは使えなくなる。
+AUTH_SECRET_KEY = os.getenv("AUTH_SECRET_KEY") or secrets.token_urlsafe(32)
+if not os.getenv("AUTH_SECRET_KEY"):
+    print("⚠️ AUTH_SECRET_KEY が未設定のため一時的な鍵を使います（再起動でトークンが無効になります）")
+ACCESS_TOKEN_TTL = int(os.getenv("ACCESS_TOKEN_TTL", 15 * 60))  # 秒
+REFRESH_TOKEN_TTL = int(os.getenv("REFRESH_TOKEN_TTL", 14 * 24 * 60 * 60))  # 秒
+AUTH_USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", 1024))
+AUTH_USER_CACHE_TTL = int(os.getenv("AUTH_USER_CACHE_TTL", 60))  # 他インスタンスでのパスワード変更はこの秒数で反映
+
+class InvalidToken(Exception):
+    pass
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+def _b64url_decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text.encode("ascii") + b"=" * (-len(text) % 4))
+
+JWT_HEADER = _b64url(json.dumps({"alg": "HS256", "typ": "JWT"}, separators=(",", ":")).encode("utf-8"))
+
+def _sign(signing_input: str) -> str:
+    return _b64url(hmac.new(AUTH_SECRET_KEY.encode("utf-8"), signing_input.encode("ascii"), hashlib.sha256).digest())
+
+def password_fingerprint(password_hash: str) -> str:
+    # パスワードハッシュから導く値（鍵付きなのでトークンからハッシュの情報は漏れない）
+    return hmac.new(AUTH_SECRET_KEY.encode("utf-8"), password_hash.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+def encode_token(user_id: int, fingerprint: str, token_type: str, ttl: int) -> str:
+    now = int(time.time())
+    claims = {"sub": str(user_id), "typ": token_type, "pwv": fingerprint, "iat": now, "exp": now + ttl}
+    payload = _b64url(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    signing_input = f"{JWT_HEADER}.{payload}"
+    return f"{signing_input}.{_sign(signing_input)}"
+
+def decode_token(token: str, token_type: str) -> dict:
+    try:
+        header, payload, signature = token.split(".")
+    except ValueError:
+        raise InvalidToken("トークンの形式が不正です")
+    # compare_digest は非 ASCII を含む str を受け付けないので bytes で比べる
+    expected = _sign(f"{header}.{payload}").encode("ascii")
+    if header != JWT_HEADER or not hmac.compare_digest(signature.encode("utf-8"), expected):
+        raise InvalidToken("トークンの署名が不正です")
+    try:
+        claims = json.loads(_b64url_decode(payload))
+    except ValueError:
+        raise InvalidToken("トークンの形式が不正です")
+    if claims.get("typ") != token_type:
+        raise InvalidToken("トークンの種類が違います")
+    if claims.get("exp", 0) < time.time():
+        raise InvalidToken("トークンの有効期限が切れています")
+    return claims
+
+def issue_tokens(user_id: int, fingerprint: str) -> dict:
+    return {
+        "access_token": encode_token(user_id, fingerprint, "access", ACCESS_TOKEN_TTL),
+        "refresh_token": encode_token(user_id, fingerprint, "refresh", REFRESH_TOKEN_TTL),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_TTL,
+    }
+
+def bearer_token(request: Request) -> Optional[str]:
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" and token.strip() else None
+
+def token_user_id(request: Request) -> Optional[int]:
+    # 署名と期限だけを見て利用者を特定する（レート制限のキー用。DB は引かない）
+    token = bearer_token(request)
+    if not token:
+        return None
+    try:
+        return int(decode_token(token, "access")["sub"])
+    except (InvalidToken, KeyError, ValueError):
+        return None
+
+class AuthUserCache:
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (期限, レコード)
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, user_id: int) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(user_id, None)
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def set(self, user_id: int, record: dict):
+        self._entries[user_id] = (time.monotonic() + self.ttl, record)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+auth_user_cache = AuthUserCache(AUTH_USER_CACHE_SIZE, AUTH_USER_CACHE_TTL)
+
+def auth_user_record(user: User) -> dict:
+    # キャッシュにはパスワードハッシュそのものを置かない
+    return {"id": user.id, "name": user.name, "email": user.email, "fingerprint": password_fingerprint(user.password or "")}
+
+def load_auth_user(user_id: int) -> Optional[dict]:
+    db = SessionLocal()
+    try:
+        user = db.get(User, user_id)
+        return auth_user_record(user) if user else None
+    finally:
+        db.close()
+
+async def resolve_token_user(token: str, token_type: str) -> dict:
+    try:
+        claims = decode_token(token, token_type)
+        user_id = int(claims["sub"])
+    except (InvalidToken, KeyError, ValueError) as e:
+        raise HTTPException(status_code=401, detail=str(e) or "トークンが不正です", headers={"WWW-Authenticate": "Bearer"})
+
+    user = auth_user_cache.get(user_id)
+    if user is None:
+        user = await run_in_threadpool(load_auth_user, user_id)
+        if user is not None:
+            auth_user_cache.set(user_id, user)
+    if user is None or not hmac.compare_digest(user["fingerprint"], claims.get("pwv", "")):
+        raise HTTPException(status_code=401, detail="トークンは無効になっています。再度ログインしてください", headers={"WWW-Authenticate": "Bearer"})
+    return user
+
+async def get_current_user(request: Request) -> dict:
+    # 認証が必要なエンドポイントの依存関数: user: dict = Depends(get_current_user)
+    token = bearer_token(request)
+    if not token:
+        raise HTTPException(status_code=401, detail="ログインが必要です", headers={"WWW-Authenticate": "Bearer"})
+    user = await resolve_token_user(token, "access")
+    request.state.user_id = user["id"]
+    return {key: value for key, value in user.items() if key != "fingerprint"}
+
+@app.post("/api/refresh")
+async def refresh_tokens(req: RefreshRequest):
+    user = await resolve_token_user(req.refresh_token, "refresh")
+    return {"user_id": user["id"], **issue_tokens(user["id"], user["fingerprint"])}
+
+@app.get("/api/me")
+async def read_current_user(user: dict = Depends(get_current_user)):
+    return user
+
+@app.post("/api/change-password")
+async def change_password(req: PasswordChangeRequest, current: dict = Depends(get_current_user), db: Session = Depends(get_db)):
+    user = await run_in_threadpool(db.get, User, current["id"])
+    if user is None:
+        raise HTTPException(status_code=401, detail="ユーザーが見つかりません")
+    verified, _ = await verify_password(req.current_password, user.password)
+    if not verified:
+        raise HTTPException(status_code=401, detail="現在のパスワードが間違っています")
+
+    new_hash = await hash_password(req.new_password)
+
+    def save():
+        user.password = new_hash
+        user.updated_at = datetime.utcnow()
+        db.commit()
+
+    await run_in_threadpool(save)
+    # 指紋が変わるので、変更前のアクセストークン・リフレッシュトークンはすべて使えなくなる
+    record = auth_user_record(user)
+    auth_user_cache.set(user.id, record)
+    return {"status": "変更完了", **issue_tokens(user.id, record["fingerprint"])}
+
 # =============================
 # アンケート送信エンドポイント
 # =============================
-@app.post("/submit")
-async def submit_answers(payload: SubmitRequest):
-    print(payload.answers)
-    # DB 接続＆カーソル取得
-    db = mysql.connector.connect(
-        host=os.getenv("MYSQL_DB_HOST"),
-        user=os.getenv("MYSQL_DB_USER"),
-        password=os.getenv("MYSQL_DB_PASSWORD"),
-        database=os.getenv("MYSQL_DB_NAME"),
-        port=int(os.getenv("MYSQL_DB_PORT", 3306))
-    )
-    cursor = db.cursor()
+SUBMIT_BACKGROUND_THRESHOLD = int(os.getenv("SUBMIT_BACKGROUND_THRESHOLD", 500))  # これを超える回答数はバックグラウンド保存
 
-    # 回答リストを1件ずつ answers テーブルに INSERT
-    for key, ans in payload.answers.items():
+def parse_answer_rows(answers: dict, now: datetime) -> list:
+    rows = []
+    for key, ans in answers.items():
+        # キーは "セクション-設問" 形式（例: "0-1"）
         try:
-            questionnaire_id_str, question_id_str = key.split("-")
-            questionnaire_id = int(questionnaire_id_str)
-            question_id = int(question_id_str)
+            section_str, question_str = str(key).split("-")
+            section, question = int(section_str), int(question_str)
         except ValueError:
             # キーの形式が不正な場合スキップ
             continue
+        rows.append({
+            "question_key": f"{section}-{question}",
+            "answer_value": None if ans is None else str(ans)[:255],
+            "created_at": now,
+            "updated_at": now,
+        })
+    return rows
+
+def save_submission(answers: dict, user_id=None, store_id=None, questionnaire_id=None) -> dict:
+    now = datetime.utcnow()
+    rows = parse_answer_rows(answers, now)
+
+    # プール済み接続 1 本・1 トランザクションで、回答はまとめて 1 回の複数行 INSERT にする
+    with engine.begin() as conn:
+        if questionnaire_id is None:
+            result = conn.execute(
+                insert(Questionnaire.__table__).values(
+                    user_id=user_id, store_id=store_id, created_at=now, updated_at=now
+                )
+            )
+            questionnaire_id = result.inserted_primary_key[0]
+        for row in rows:
+            row["questionnaire_id"] = questionnaire_id
+        if rows:
+            conn.execute(insert(Answer.__table__), rows)
+
+    return {"questionnaire_id": questionnaire_id, "saved": len(rows)}
+
+def save_submission_in_background(answers: dict, user_id=None, store_id=None, questionnaire_id=None):
+    try:
+        result = save_submission(answers, user_id, store_id, questionnaire_id)
+        print(f"✅ アンケート保存完了（バックグラウンド）: {result}")
+    except Exception:
+        import traceback
+        traceback.print_exc()
 
-    # 回答リストを1件ずつ answers テーブルに INSERT
-        cursor.execute(
-            "INSERT INTO answers (questionnaire_id, question_id, answer_text) VALUES (%s, %s, %s)",
-            (None, None, ans)  # 仮で questionnaire_id / question_id を None にしている場合
+@app.post("/submit")
+async def submit_answers(payload: SubmitRequest, background_tasks: BackgroundTasks):
+    # 大きなアンケートや background 指定時はレスポンスを先に返して保存は後で行う
+    if payload.background or len(payload.answers) > SUBMIT_BACKGROUND_THRESHOLD:
+        background_tasks.add_task(
+            save_submission_in_background,
+            payload.answers, payload.user_id, payload.store_id, payload.questionnaire_id
         )
+        return {"status": "受付済み"}
 
-    db.commit()
-    cursor.close()
-    db.close()
+    try:
+        result = await run_in_threadpool(
+            save_submission,
+            payload.answers, payload.user_id, payload.store_id, payload.questionnaire_id
+        )
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"error": f"保存エラー: {str(e)}"})
 
-    return {"status": "保存成功"}
+    return {"status": "保存成功", **result}
 # Line247～337 追加✅ Githubに追加！
+
+# =============================
+# 🩺 経営診断回答 API（一括 upsert / 最新回答の取得）
+# =============================
+def upsert_diagnosis_answers(user_id: int, store_id: int, answers: Dict[str, str]) -> int:
+    now = datetime.utcnow()
+    rows = [
+        {
+            "user_id": user_id,
+            "store_id": store_id,
+            "question_key": str(key)[:20],
+            "answer": None if value is None else str(value)[:255],
+            "created_at": now,
+        }
+        for key, value in answers.items()
+    ]
+    if not rows:
+        return 0
+
+    # (user_id, store_id, question_key) が既にあれば回答と日時だけを更新する 1 文の upsert
+    stmt = upsert_statement(
+        DiagnosisAnswer.__table__, rows, ["user_id", "store_id", "question_key"],
+        lambda new: {"answer": new.answer, "created_at": new.created_at},
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt)
+    return len(rows)
+
+def load_latest_diagnosis_answers(store_id: int) -> dict:
+    # ix_diagnosis_answers_store_latest だけで完結する列のみを読む
+    stmt = (
+        select(DiagnosisAnswer.question_key, DiagnosisAnswer.answer, DiagnosisAnswer.created_at)
+        .where(DiagnosisAnswer.store_id == store_id)
+        .order_by(DiagnosisAnswer.created_at.desc())
+    )
+    answers = {}
+    updated_at = None
+    with engine.connect() as conn:
+        for question_key, answer, created_at in conn.execute(stmt):
+            if updated_at is None:
+                updated_at = created_at
+            # 同じ設問に複数ユーザーの回答がある場合は最新を採用
+            answers.setdefault(question_key, answer)
+    return {"store_id": store_id, "answers": answers, "updated_at": updated_at}
+
+@app.post("/api/diagnosis")
+async def save_diagnosis(req: DiagnosisRequest):
+    try:
+        saved = await run_in_threadpool(upsert_diagnosis_answers, req.user_id, req.store_id, req.answers)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"error": f"保存エラー: {str(e)}"})
+    # スコア表の該当店舗の行だけを書き換える（全体の再読み込みはしない）
+    await run_in_threadpool(diagnosis_scores.apply, req.store_id, req.answers)
+    return {"status": "保存成功", "saved": saved}
+
+@app.get("/api/diagnosis/{store_id}")
+async def get_latest_diagnosis(store_id: int):
+    return await run_in_threadpool(load_latest_diagnosis_answers, store_id)
         
-# ============================
-# 🧠 経営分析APIエンドポイント
-# ============================
-from openai import AzureOpenAI
+# =============================
+# 🧮 経営診断スコア（セクション別スコア / 全店舗中のパーセンタイル）
+# =============================
+# 回答を「店舗 × 設問」の float32 行列（未回答は NaN）に持ち、セクション別スコアと順位を行列演算でまとめて計算する。
+# 初回に全店舗分を読み込み、以降は /api/diagnosis の保存時に該当店舗の行だけを更新する。
+# 集計結果は次に参照されたときに 1 回だけ再計算する。他インスタンスでの更新は定期的な再読み込みで取り込む。
+DIAGNOSIS_SCORE_RELOAD_SECONDS = int(os.getenv("DIAGNOSIS_SCORE_RELOAD_SECONDS", 300))
+DIAGNOSIS_SCALE_MAX = float(os.getenv("DIAGNOSIS_SCALE_MAX", 5))  # 数値回答（1〜5 など）の満点
+ANSWER_SCORES = {
+    "yes": 1.0, "はい": 1.0, "true": 1.0, "○": 1.0,
+    "no": 0.0, "いいえ": 0.0, "false": 0.0, "×": 0.0,
+    "どちらでもない": 0.5, "一部": 0.5, "partial": 0.5, "△": 0.5,
+}
 
-@app.post("/api/analyze")
-async def analyze(req: AnalysisRequest):
+def answer_score(value) -> float:
+    # 0.0〜1.0 に正規化する。解釈できない回答は未回答（NaN）扱い
+    if value is None:
+        return float("nan")
+    text = str(value).strip().lower()
+    if text in ANSWER_SCORES:
+        return ANSWER_SCORES[text]
+    try:
+        return min(1.0, max(0.0, float(text) / DIAGNOSIS_SCALE_MAX))
+    except ValueError:
+        return float("nan")
+
+def parse_question_key(key) -> Optional[tuple]:
+    try:
+        section, question = str(key).split("-")
+        return int(section), int(question)
+    except ValueError:
+        return None
+
+def percentile_ranks(scores: "np.ndarray") -> "np.ndarray":
+    # 列ごとに、値のある店舗の中での位置（同点は中間）を 0〜100 で返す
+    ranks = np.full(scores.shape, np.nan)
+    for j in range(scores.shape[1]):
+        column = scores[:, j]
+        valid = ~np.isnan(column)
+        if not valid.any():
+            continue
+        ordered = np.sort(column[valid])
+        below = np.searchsorted(ordered, column[valid], side="left")
+        equal = np.searchsorted(ordered, column[valid], side="right") - below
+        ranks[valid, j] = (below + 0.5 * equal) / len(ordered) * 100
+    return ranks
+
+def score_value(value) -> Optional[float]:
+    return None if np.isnan(value) else round(float(value), 1)
+
+class DiagnosisScoreBoard:
+    def __init__(self):
+        self._lock = threading.Lock()  # 行列の読み書き（短時間だけ持つ）
+        self._load_lock = threading.Lock()  # DB からの読み直しを 1 本にまとめる
+        self._pending = None  # 読み直し中に届いた回答（読み直し後に反映し直す）
+        self.loaded_at = None
+        self._reset()
+
+    def _reset(self):
+        self.store_index = {}  # store_id -> 行
+        self.key_index = {}  # (セクション, 設問) -> 列
+        self.values = np.full((64, 64), np.nan, dtype=np.float32)  # 容量は倍々で増やす
+        self.sections = np.zeros(64, dtype=np.int32)  # 列 -> セクション番号
+        self._summary = None  # 集計結果（更新されたら None に戻す）
+
+    def _set(self, store_id: int, answers: dict):
+        row = self.store_index.setdefault(store_id, len(self.store_index))
+        for key, value in answers.items():
+            parsed = parse_question_key(key)
+            if parsed is None:
+                continue
+            col = self.key_index.setdefault(parsed, len(self.key_index))
+            rows, cols = self.values.shape
+            if row >= rows or col >= cols:
+                grown = np.full((max(rows, (row + 1) * 2), max(cols, (col + 1) * 2)), np.nan, dtype=np.float32)
+                grown[:rows, :cols] = self.values
+                self.values = grown
+                self.sections = np.concatenate([self.sections, np.zeros(grown.shape[1] - cols, dtype=np.int32)])
+            self.sections[col] = parsed[0]
+            self.values[row, col] = answer_score(value)
+        self._summary = None
+
+    def _stale(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > DIAGNOSIS_SCORE_RELOAD_SECONDS
+
+    def _load(self):
+        # 全件の読み込みはロックの外で新しい行列に行い、最後に差し替える（その間も apply や参照は止めない）
+        # 同じ設問に複数ユーザーの回答がある場合は最新を採用（load_latest_diagnosis_answers と同じ）
+        with self._load_lock:
+            if not self._stale():
+                return  # 別のスレッドが読み直し済み
+            stmt = (
+                select(DiagnosisAnswer.store_id, DiagnosisAnswer.question_key, DiagnosisAnswer.answer)
+                .order_by(DiagnosisAnswer.created_at.asc())
+            )
+            with self._lock:
+                self._pending = []
+            fresh = DiagnosisScoreBoard()
+            try:
+                with engine.connect() as conn:
+                    for store_id, question_key, answer in conn.execute(stmt):
+                        fresh._set(store_id, {question_key: answer})
+            except Exception:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                # 読み込み中に保存された回答はスキャンに含まれていないことがあるので上書きで反映する
+                for store_id, answers in self._pending:
+                    fresh._set(store_id, answers)
+                self._pending = None
+                self.store_index, self.key_index = fresh.store_index, fresh.key_index
+                self.values, self.sections = fresh.values, fresh.sections
+                self._summary = None
+                self.loaded_at = time.monotonic()
+
+    def apply(self, store_id: int, answers: dict):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((store_id, answers))
+            if self.loaded_at is not None:  # 未読み込みなら次の参照時に DB から読む
+                self._set(store_id, answers)
+
+    def _compute(self) -> dict:
+        if self._summary is not None:
+            return self._summary
+
+        n_stores, n_keys = len(self.store_index), len(self.key_index)
+        values = self.values[:n_stores, :n_keys]
+        answered = ~np.isnan(values)
+        filled = np.where(answered, values, 0.0)
+        section_ids, section_of_key = np.unique(self.sections[:n_keys], return_inverse=True)
+        onehot = np.zeros((n_keys, len(section_ids)), dtype=np.float32)
+        onehot[np.arange(n_keys), section_of_key] = 1.0
+
+        # 0 列目が全体、1 列目以降がセクション
+        sums = np.column_stack([filled.sum(axis=1), filled @ onehot])
+        counts = np.column_stack([answered.sum(axis=1), answered.astype(np.float32) @ onehot])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scores = np.where(counts > 0, sums / counts * 100, np.nan)
+        self._summary = {
+            "section_ids": section_ids,
+            "questions": np.concatenate([[n_keys], onehot.sum(axis=0)]),
+            "scores": scores,
+            "counts": counts,
+            "percentiles": percentile_ranks(scores),
+        }
+        return self._summary
+
+    def store_scores(self, store_id: int) -> Optional[dict]:
+        if self._stale():
+            self._load()
+        with self._lock:
+            summary = self._compute()
+            row = self.store_index.get(store_id)
+            if row is None:
+                return None
+
+            def entry(j: int) -> dict:
+                return {
+                    "score": score_value(summary["scores"][row, j]),
+                    "percentile": score_value(summary["percentiles"][row, j]),
+                    "answered": int(summary["counts"][row, j]),
+                    "questions": int(summary["questions"][j]),
+                }
+
+            return {
+                "store_id": store_id,
+                "overall": entry(0),
+                "sections": [{"section": int(section), **entry(j + 1)} for j, section in enumerate(summary["section_ids"])],
+                "stores": len(self.store_index),
+            }
+
+    def distribution(self) -> dict:
+        if self._stale():
+            self._load()
+        with self._lock:
+            summary = self._compute()
+            scores = summary["scores"]
+
+            def describe(j: int) -> dict:
+                column = scores[:, j][~np.isnan(scores[:, j])]
+                if not len(column):
+                    return {"stores": 0, "mean": None, "p25": None, "median": None, "p75": None}
+                p25, median, p75 = np.percentile(column, [25, 50, 75])
+                return {"stores": int(len(column)), "mean": score_value(column.mean()),
+                        "p25": score_value(p25), "median": score_value(median), "p75": score_value(p75)}
+
+            return {
+                "overall": describe(0),
+                "sections": [{"section": int(section), **describe(j + 1)} for j, section in enumerate(summary["section_ids"])],
+            }
+
+diagnosis_scores = DiagnosisScoreBoard()
+
+@app.get("/api/diagnosis/scores/summary")
+async def diagnosis_score_distribution():
+    return await run_in_threadpool(diagnosis_scores.distribution)
+
+@app.get("/api/diagnosis/{store_id}/scores")
+async def get_diagnosis_scores(store_id: int):
+    scores = await run_in_threadpool(diagnosis_scores.store_scores, store_id)
+    if scores is None:
+        return JSONResponse(status_code=404, content={"error": "診断回答がありません"})
+    return scores
+
+# =============================
+# 📋 アンケート回答の閲覧 API（キーセットページング）
+# =============================
+# OFFSET を使わず「最後に返した (created_at, id)」より古いものを読むので、件数が増えてもページの深さに依存しない。
+# 回答は joinedload で同じクエリで読み、format=columnar なら列ごとの配列で返す。
+QUESTIONNAIRE_PAGE_DEFAULT = int(os.getenv("QUESTIONNAIRE_PAGE_DEFAULT", 20))
+QUESTIONNAIRE_PAGE_MAX = int(os.getenv("QUESTIONNAIRE_PAGE_MAX", 100))
+
+def encode_questionnaire_cursor(created_at: Optional[datetime], questionnaire_id: int) -> str:
+    raw = json.dumps([created_at.isoformat() if created_at else None, questionnaire_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_questionnaire_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii") + b"=" * (-len(cursor) % 4))
+        created_at, questionnaire_id = json.loads(raw)
+        return (datetime.fromisoformat(created_at) if created_at else None), int(questionnaire_id)
+    except Exception:
+        raise ValueError("cursor が不正です")
+
+def list_questionnaires(owner_column, owner_id: int, limit: int, cursor: Optional[str] = None) -> tuple:
+    # (アンケートのリスト, 次ページの cursor) を返す。並びは created_at 降順・id 降順
+    stmt = (
+        select(Questionnaire)
+        .where(owner_column == owner_id)
+        .order_by(Questionnaire.created_at.desc(), Questionnaire.id.desc())
+        .limit(limit + 1)  # 1 件多く読んで次ページの有無を判定する
+        .options(joinedload(Questionnaire.answers))
+    )
+    if cursor:
+        created_at, questionnaire_id = decode_questionnaire_cursor(cursor)
+        if created_at is None:
+            # 降順では created_at が NULL の行が最後に並ぶ
+            stmt = stmt.where(Questionnaire.created_at.is_(None), Questionnaire.id < questionnaire_id)
+        else:
+            stmt = stmt.where(or_(
+                Questionnaire.created_at < created_at,
+                and_(Questionnaire.created_at == created_at, Questionnaire.id < questionnaire_id),
+                Questionnaire.created_at.is_(None),
+            ))
+
+    db = SessionLocal()
+    try:
+        rows = db.execute(stmt).unique().scalars().all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_questionnaire_cursor(rows[-1].created_at, rows[-1].id)
+        return [
+            {
+                "id": row.id,
+                "user_id": row.user_id,
+                "store_id": row.store_id,
+                "created_at": row.created_at,
+                "answers": [(a.question_key, a.answer_value) for a in row.answers],
+            }
+            for row in rows
+        ], next_cursor
+    finally:
+        db.close()
+
+def questionnaire_page_response(questionnaires: list, next_cursor: Optional[str], format: str) -> dict:
+    if format == "columnar":
+        # キー名を行ごとに繰り返さない列指向の形（回答は questionnaire_id で親に対応付ける）
+        return {
+            "questionnaires": {
+                "id": [q["id"] for q in questionnaires],
+                "user_id": [q["user_id"] for q in questionnaires],
+                "store_id": [q["store_id"] for q in questionnaires],
+                "created_at": [q["created_at"].isoformat() if q["created_at"] else None for q in questionnaires],
+            },
+            "answers": {
+                "questionnaire_id": [q["id"] for q in questionnaires for _ in q["answers"]],
+                "question_key": [key for q in questionnaires for key, _ in q["answers"]],
+                "answer_value": [value for q in questionnaires for _, value in q["answers"]],
+            },
+            "next_cursor": next_cursor,
+        }
+    return {
+        "questionnaires": [
+            {**q, "answers": [{"question_key": key, "answer_value": value} for key, value in q["answers"]]}
+            for q in questionnaires
+        ],
+        "next_cursor": next_cursor,
+    }
+
+async def questionnaire_page(owner_column, owner_id: int, limit: int, cursor: Optional[str], format: str):
+    if format not in ("rows", "columnar"):
+        return JSONResponse(status_code=400, content={"error": "format は rows または columnar を指定してください"})
+    limit = max(1, min(limit, QUESTIONNAIRE_PAGE_MAX))
     try:
-        client = AzureOpenAI(
+        questionnaires, next_cursor = await run_in_threadpool(list_questionnaires, owner_column, owner_id, limit, cursor)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return questionnaire_page_response(questionnaires, next_cursor, format)
+
+@app.get("/api/stores/{store_id}/questionnaires")
+async def list_store_questionnaires(store_id: int, limit: int = QUESTIONNAIRE_PAGE_DEFAULT, cursor: Optional[str] = None, format: str = "rows"):
+    return await questionnaire_page(Questionnaire.store_id, store_id, limit, cursor, format)
+
+@app.get("/api/users/{user_id}/questionnaires")
+async def list_user_questionnaires(user_id: int, limit: int = QUESTIONNAIRE_PAGE_DEFAULT, cursor: Optional[str] = None, format: str = "rows"):
+    return await questionnaire_page(Questionnaire.user_id, user_id, limit, cursor, format)
+
+# ================================
+# 🤖 Azure OpenAI 共通クライアント
+# ================================
+# リクエストごとに AzureOpenAI を作らず、プロセス全体で AsyncAzureOpenAI を使い回す。
+# HTTP 接続は keep-alive でプールし、デプロイメントごとに同時実行数を制限する。
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 120))  # 秒
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", 10))  # 秒
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 100))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 2))
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", 32))  # 分析デプロイメントの同時実行数
+DALLE_CONCURRENCY = int(os.getenv("DALLE_CONCURRENCY", 2))  # 画像生成デプロイメントの同時実行数
+DALLE_TIMEOUT = float(os.getenv("DALLE_TIMEOUT", 180))  # 秒
+
+OPENAI_DEPLOYMENT = os.getenv("OPENAI_MODEL", "gpt-4o-3")
+DALLE_DEPLOYMENT = os.getenv("DALLE_DEPLOYMENT_NAME", "dall-e-3")
+
+openai_clients: Dict[str, "AsyncAzureOpenAI"] = {}
+deployment_semaphores: Dict[str, asyncio.Semaphore] = {
+    OPENAI_DEPLOYMENT: asyncio.Semaphore(OPENAI_CONCURRENCY),
+    DALLE_DEPLOYMENT: asyncio.Semaphore(DALLE_CONCURRENCY),
+}
+
+def _build_openai_client(api_key, api_version, azure_endpoint, timeout, max_retries=OPENAI_MAX_RETRIES) -> "AsyncAzureOpenAI":
+    from openai import AsyncAzureOpenAI
+
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        timeout=httpx.Timeout(timeout, connect=OPENAI_CONNECT_TIMEOUT),
+    )
+    return AsyncAzureOpenAI(
+        api_key=api_key,
+        api_version=api_version,
+        azure_endpoint=azure_endpoint,
+        max_retries=max_retries,
+        timeout=httpx.Timeout(timeout, connect=OPENAI_CONNECT_TIMEOUT),
+        http_client=http_client,
+    )
+
+def get_chat_client() -> "AsyncAzureOpenAI":
+    if "chat" not in openai_clients:
+        openai_clients["chat"] = _build_openai_client(
+            api_key=os.getenv("OPENAI_API_KEY"),
             api_version=os.getenv("OPENAI_API_VERSION", "2025-01-01-preview"),
             azure_endpoint=os.getenv("OPENAI_API_BASE"),
-            api_key=os.getenv("OPENAI_API_KEY")
+            timeout=OPENAI_TIMEOUT,
+            max_retries=0,  # 429 などの再試行はレート予算と連動させて call_openai_with_budget で行う
         )
+    return openai_clients["chat"]
 
-        completion = client.chat.completions.create(
-            model=os.getenv("OPENAI_MODEL", "gpt-4o-3"),
-            messages=[
-                {"role": "system", "content": "あなたは百戦錬磨の優秀な地方中小企業の経営コンサルタントです。"},
-                {"role": "user", "content": req.prompt}
-            ],
-            temperature=1.0,
-            top_p=1.0
+def get_dalle_client() -> "AsyncAzureOpenAI":
+    if "dalle" not in openai_clients:
+        openai_clients["dalle"] = _build_openai_client(
+            api_key=os.getenv("DALLE_API_KEY"),
+            api_version=os.getenv("DALLE_API_VERSION", "2024-02-01"),
+            azure_endpoint=os.getenv("DALLE_API_BASE"),
+            timeout=DALLE_TIMEOUT,
         )
-        return {"result": completion.choices[0].message.content}
+    return openai_clients["dalle"]
 
-    except Exception as e:
-        import traceback
-        traceback.print_exc()  # ログ出力のため
-        return JSONResponse(status_code=500, content={"error": f"Internal Server Error: {str(e)}"})
+def deployment_slot(deployment: str) -> asyncio.Semaphore:
+    # 未登録のデプロイメントは分析用と同じ上限で扱う
+    if deployment not in deployment_semaphores:
+        deployment_semaphores[deployment] = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    return deployment_semaphores[deployment]
+
+async def close_openai_clients():
+    for client in openai_clients.values():
+        await client.close()
+    openai_clients.clear()
 
 # ================================
-# 🖼 SNSキャンペーン画像生成API
+# ⏱ Azure OpenAI のレート予算（RPM / TPM）と 429 再試行
 # ================================
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from openai import AzureOpenAI
-import os
+# デプロイメントのクォータ（1 分あたりのリクエスト数・トークン数）をプロセス全体で共有し、
+# 予算を超える呼び出しは送信前に待たせる。429 を受けたら Retry-After か指数バックオフの間、全体を止める。
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", 0))  # 0 は無制限
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", 0))  # 0 は無制限
+OPENAI_RATE_LIMIT_RETRIES = int(os.getenv("OPENAI_RATE_LIMIT_RETRIES", 6))  # 429 の再試行回数
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", 1.0))  # 秒
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", 60.0))  # 秒
+
+class RateBudget:
+    # リクエスト数・トークン数それぞれを 1 分で満タンになるバケツとして連続的に補充する
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()  # 待ち合わせは到着順
+        self.stats = {"acquired": 0, "waited_seconds": 0.0, "rate_limited": 0}
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        if self.tpm:
+            tokens = min(tokens, self.tpm)  # 1 回で予算全体を超える呼び出しも、満タンになれば通す
+        started = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if self.rpm and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+                if self.tpm and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    break
+                await asyncio.sleep(wait)
+        self.stats["acquired"] += 1
+        self.stats["waited_seconds"] += time.monotonic() - started
+
+    def settle(self, reserved: int, used: int):
+        # 見積もりとの差を戻す（見積もりを超えていれば差し引く）
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + reserved - used)
+
+    def pause(self, seconds: float):
+        self.stats["rate_limited"] += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def status(self) -> dict:
+        self._refill(time.monotonic())
+        return {
+            "rpm_limit": self.rpm,
+            "tpm_limit": self.tpm,
+            "requests_available": round(self._requests, 2) if self.rpm else None,
+            "tokens_available": int(self._tokens) if self.tpm else None,
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 2),
+            **self.stats,
+            "waited_seconds": round(self.stats["waited_seconds"], 2),
+        }
 
-app = FastAPI()
+openai_budget = RateBudget(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+
+def retry_after_seconds(error) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = response.headers.get(header)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                continue  # HTTP 日付形式は使わずバックオフに任せる
+    return None
+
+def openai_reservation(messages: list, max_tokens: int) -> int:
+    # 呼び出し前に予約するトークン数（入力 + 応答の上限）
+    return count_message_tokens(messages) + max_tokens
+
+async def call_openai_with_budget(create, messages: list, max_tokens: int, budget: RateBudget = openai_budget):
+    # create は呼ぶたびに新しいリクエストを送るコルーチン関数
+    # ストリームの応答には usage が無いので、予約の精算は呼び出し側がストリーム終了時に行う
+    import openai
+
+    reserved = openai_reservation(messages, max_tokens)
+    attempt = 0
+    while True:
+        await budget.acquire(reserved)
+        try:
+            response = await create()
+        except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+            budget.settle(reserved, 0)  # 拒否・失敗した呼び出しはトークンを消費していない
+            rate_limited = isinstance(e, openai.RateLimitError)
+            limit = OPENAI_RATE_LIMIT_RETRIES if rate_limited else OPENAI_MAX_RETRIES
+            if attempt >= limit:
+                raise
+            delay = min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+            retry_after = retry_after_seconds(e)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if rate_limited:
+                budget.pause(delay)  # 同じクォータを使う他の呼び出しもまとめて待たせる
+            attempt += 1
+            print(f"⏳ Azure OpenAI {type(e).__name__}: {delay:.1f} 秒後に再試行します（{attempt}/{limit}）")
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            budget.settle(reserved, 0)  # 再試行しないエラーや取り消しでも予約を残さない
+            raise
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            budget.settle(reserved, usage.total_tokens)
+        return response
+
+@app.get("/api/openai-budget")
+async def openai_budget_status():
+    return openai_budget.status()
 
-class AnalysisRequest(BaseModel):
-    prompt: str
+# ============================
+# 🧠 経営分析APIエンドポイント
+# ============================
+ANALYSIS_SYSTEM_PROMPT = "あなたは百戦錬磨の優秀な地方中小企業の経営コンサルタントです。"
+ANALYSIS_PARAMS = {
+    "temperature": 1.0,
+    "top_p": 1.0,
+    "max_tokens": 2048,  # 🔧 応答長を確保
+}
 
-class ImageRequest(BaseModel):
-    analysis_summary: str
+def build_analysis_messages(prompt: str) -> list:
+    return [
+        {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
 
 # ============================
-# 🧠 経営分析APIエンドポイント
+# 🧮 プロンプトのトークン予算
 # ============================
-@app.post("/api/analyze")
+# 送信前にトークン数を数え、アンケート回答の羅列は表形式に圧縮し、それでも予算を超える段落は切り詰める。
+# max_tokens は入力の大きさとコンテキスト長から決めるので、TPM の予約も実際の必要量に近づく。
+ANALYSIS_CONTEXT_TOKENS = int(os.getenv("ANALYSIS_CONTEXT_TOKENS", 128000))  # モデルのコンテキスト長
+ANALYSIS_INPUT_TOKEN_BUDGET = int(os.getenv("ANALYSIS_INPUT_TOKEN_BUDGET", 8000))  # ユーザープロンプトの上限
+ANALYSIS_MIN_OUTPUT_TOKENS = int(os.getenv("ANALYSIS_MIN_OUTPUT_TOKENS", 256))
+ANALYSIS_MAX_OUTPUT_TOKENS = ANALYSIS_PARAMS["max_tokens"]
+ANALYSIS_COMPACT_MIN_ANSWERS = int(os.getenv("ANALYSIS_COMPACT_MIN_ANSWERS", 8))  # これ未満の回答は圧縮しない
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "o200k_base")  # gpt-4o 系のエンコーディング
+
+# 診断回答のキーは "セクション-設問"（どちらも 1〜2 桁）。"2024-01: 売上 10万円" のような年月などは対象にしない
+ANSWER_PAIR_PATTERN = re.compile(r'"?(?<![\d-])(\d{1,2})-(\d{1,2})(?![\d-])"?\s*[:：=]\s*"?([^",\n{}]*?)"?\s*(?=[,，}\n]|$)')
+token_encoder = None  # False は tiktoken が使えないことを表す
+
+def get_token_encoder():
+    # tiktoken は任意依存。未インストールやエンコーディングを取得できない環境では概算に切り替える
+    global token_encoder
+    if token_encoder is None:
+        try:
+            import tiktoken
+            token_encoder = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+        except Exception as e:
+            print(f"⚠️ tiktoken を使えないためトークン数は概算で数えます: {e}")
+            token_encoder = False
+    return token_encoder or None
+
+def count_tokens(text: str) -> int:
+    encoder = get_token_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    # 概算: 英数字は 4 文字で 1 トークン、日本語などは 1 文字 1 トークン（多めに見積もる）
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def count_message_tokens(messages: list) -> int:
+    # メッセージごとの役割トークンと、応答開始分の固定オーバーヘッドを含める
+    return sum(count_tokens(str(m.get("content", ""))) + 4 for m in messages) + 3
+
+def truncate_to_tokens(text: str, limit: int) -> str:
+    if limit <= 0:
+        return ""
+    encoder = get_token_encoder()
+    if encoder is not None:
+        tokens = encoder.encode(text, disallowed_special=())
+        return text if len(tokens) <= limit else encoder.decode(tokens[:limit])
+    while text and count_tokens(text) > limit:
+        text = text[:max(0, min(len(text) - 1, len(text) * limit // count_tokens(text)))]
+    return text
+
+def compress_numbers(numbers: list) -> str:
+    # [0, 1, 2, 5] -> "0〜2,5"
+    parts = []
+    start = prev = None
+    for n in sorted(set(numbers)):
+        if prev is not None and n == prev + 1:
+            prev = n
+            continue
+        if start is not None:
+            parts.append(str(start) if start == prev else f"{start}〜{prev}")
+        start = prev = n
+    if start is not None:
+        parts.append(str(start) if start == prev else f"{start}〜{prev}")
+    return ",".join(parts)
+
+def answers_table(pairs: list) -> str:
+    # セクションごとに「回答=設問番号の並び」へまとめる（情報は落とさない）
+    sections = OrderedDict()
+    for section, question, answer in pairs:
+        sections.setdefault(section, OrderedDict()).setdefault(answer.strip() or "(空欄)", []).append(question)
+    lines = ["【回答表】セクション: 回答=設問番号"]
+    for section in sorted(sections):
+        groups = " / ".join(f"{answer}={compress_numbers(questions)}" for answer, questions in sections[section].items())
+        lines.append(f"{section}: {groups}")
+    return "\n".join(lines)
+
+def compact_answer_lines(prompt: str) -> str:
+    # "0-1: Yes" の行や {"0-1": "Yes", ...} の JSON が続く部分を 1 つの表に置き換える
+    output = []
+    block = []
+
+    def flush():
+        if len(block) >= ANALYSIS_COMPACT_MIN_ANSWERS:
+            output.append(answers_table(block))
+        else:
+            output.extend(f"{s}-{q}: {a}" for s, q, a in block)
+        block.clear()
+
+    for line in prompt.splitlines():
+        pairs = ANSWER_PAIR_PATTERN.findall(line)
+        rest = ANSWER_PAIR_PATTERN.sub("", line).strip(" \t{},，")
+        if pairs and not rest:
+            block.extend((int(s), int(q), a) for s, q, a in pairs)
+            continue
+        flush()
+        output.append(line.rstrip())
+    flush()
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(output)).strip()
+
+def trim_to_budget(prompt: str, budget: int) -> str:
+    # 段落（空行区切り）のうち最も長いものから切り詰める。最後の段落は指示文とみなして極力残す
+    paragraphs = prompt.split("\n\n")
+    counts = [count_tokens(p) for p in paragraphs]
+    marker = "…（省略）"
+    total = count_tokens(prompt)
+    while total > budget:
+        candidates = range(len(paragraphs) - 1) if len(paragraphs) > 1 else range(len(paragraphs))
+        longest = max(candidates, key=lambda i: counts[i])
+        if counts[longest] == 0:
+            return truncate_to_tokens("\n\n".join(p for p in paragraphs if p), budget)
+        keep = counts[longest] - (total - budget) - count_tokens(marker)
+        paragraphs[longest] = truncate_to_tokens(paragraphs[longest], keep) + marker if keep > 0 else ""
+        counts[longest] = count_tokens(paragraphs[longest])
+        total = count_tokens("\n\n".join(p for p in paragraphs if p))
+    return "\n\n".join(p for p in paragraphs if p)
+
+def prepare_analysis(req: AnalysisRequest) -> dict:
+    prompt_tokens_raw = count_tokens(req.prompt)
+    prompt = compact_answer_lines(req.prompt) if req.compact_answers else req.prompt.strip()
+    compacted = prompt != req.prompt.strip()
+    trimmed = False
+    if count_tokens(prompt) > ANALYSIS_INPUT_TOKEN_BUDGET:
+        prompt = trim_to_budget(prompt, ANALYSIS_INPUT_TOKEN_BUDGET)
+        trimmed = True
+
+    messages = build_analysis_messages(prompt)
+    input_tokens = count_message_tokens(messages)
+    # 要求された応答長（既定は上限）を、コンテキストの残りに収まるよう調整する
+    requested = req.max_tokens or ANALYSIS_MAX_OUTPUT_TOKENS
+    remaining = max(ANALYSIS_MIN_OUTPUT_TOKENS, ANALYSIS_CONTEXT_TOKENS - input_tokens)
+    max_tokens = max(1, min(requested, ANALYSIS_MAX_OUTPUT_TOKENS, remaining))
+    return {
+        "prompt": prompt,
+        "messages": messages,
+        "params": {**ANALYSIS_PARAMS, "max_tokens": max_tokens},
+        "usage": {
+            "prompt_tokens_raw": prompt_tokens_raw,
+            "prompt_tokens": input_tokens,
+            "max_tokens": max_tokens,
+            "compacted": compacted,
+            "trimmed": trimmed,
+            "tokenizer": "tiktoken" if get_token_encoder() is not None else "estimate",
+        },
+    }
+
+# ============================
+# 🗃 経営分析キャッシュ（LRU + TTL / 任意で MySQL 共有）
+# ============================
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "false").lower() == "true"
+ANALYSIS_CACHE_SHARED = os.getenv("ANALYSIS_CACHE_SHARED", "false").lower() == "true"
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", 24 * 60 * 60))  # 秒
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 512))
+
+class AnalysisCache:
+    def __init__(self, max_entries: int, ttl: int, shared: bool):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()  # key -> (expires_at(monotonic), result)
+        self.stats = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(deployment: str, system_prompt: str, prompt: str, params: dict) -> str:
+        normalized = {
+            "deployment": deployment,
+            "system": " ".join(system_prompt.split()),
+            "prompt": " ".join(prompt.split()),  # 空白・改行の揺れは同一視する
+            "params": params,
+        }
+        raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, result = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return result
+            del self._entries[key]
+
+        if self.shared:
+            result = await run_in_threadpool(self._get_shared, key)
+            if result is not None:
+                self._put_local(key, result)
+                self.stats["shared_hits"] += 1
+                return result
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, result: str):
+        self._put_local(key, result)
+        if self.shared:
+            await run_in_threadpool(self._set_shared, key, result)
+
+    def _put_local(self, key: str, result: str):
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _get_shared(self, key: str):
+        db = SessionLocal()
+        try:
+            entry = db.get(AnalysisCacheEntry, key)
+            if entry is None:
+                return None
+            if entry.expires_at <= datetime.utcnow():
+                db.delete(entry)
+                db.commit()
+                return None
+            return entry.result
+        finally:
+            db.close()
+
+    def _set_shared(self, key: str, result: str):
+        db = SessionLocal()
+        try:
+            db.merge(AnalysisCacheEntry(
+                cache_key=key,
+                result=result,
+                expires_at=datetime.utcnow() + timedelta(seconds=self.ttl),
+                created_at=datetime.utcnow(),
+            ))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print("❌ 分析キャッシュ保存エラー:", str(e))
+        finally:
+            db.close()
+
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_MAX_ENTRIES, ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_SHARED)
+
+def analysis_cache_key(req: AnalysisRequest, plan: dict):
+    # キャッシュ無効時・バイパス指定時は None を返す。圧縮後のプロンプトと実際のパラメータで引く
+    if not ANALYSIS_CACHE_ENABLED or req.no_cache:
+        return None
+    return AnalysisCache.make_key(OPENAI_DEPLOYMENT, ANALYSIS_SYSTEM_PROMPT, plan["prompt"], plan["params"])
+
+@app.get("/api/analyze/cache-stats")
+async def analysis_cache_stats():
+    return {
+        "enabled": ANALYSIS_CACHE_ENABLED,
+        "shared": ANALYSIS_CACHE_SHARED,
+        "entries": len(analysis_cache._entries),
+        **analysis_cache.stats,
+    }
+
+async def complete_analysis(req: AnalysisRequest) -> tuple:
+    # (結果, キャッシュから返したか, トークン数) を返す。/api/analyze とバッチ分析で共用
+    plan = prepare_analysis(req)
+    usage = plan["usage"]
+    cache_key = analysis_cache_key(req, plan)
+    if cache_key:
+        cached = await analysis_cache.get(cache_key)
+        if cached is not None:
+            return cached, True, usage
+
+    async def call():
+        async with deployment_slot(OPENAI_DEPLOYMENT):
+            with trace_span("openai_completion"):
+                return await call_openai_with_budget(
+                    lambda: get_chat_client().chat.completions.create(
+                        model=OPENAI_DEPLOYMENT,
+                        messages=plan["messages"],
+                        **plan["params"]
+                    ),
+                    plan["messages"],
+                    plan["params"]["max_tokens"],
+                )
+
+    # 同じプロンプト・パラメータの同時リクエストは 1 回の呼び出しにまとめる（キャッシュ無効時も）
+    flight_key = "analyze:" + AnalysisCache.make_key(OPENAI_DEPLOYMENT, ANALYSIS_SYSTEM_PROMPT, plan["prompt"], plan["params"])
+    completion = await request_flights.do(flight_key, call)
+    result = completion.choices[0].message.content
+    if completion.usage is not None:
+        # 実際に課金されたトークン数で上書きする
+        usage = {**usage, "prompt_tokens": completion.usage.prompt_tokens, "completion_tokens": completion.usage.completion_tokens}
+    if cache_key and result:
+        await analysis_cache.set(cache_key, result)
+    return result, False, usage
+
+@app.post("/api/analyze", dependencies=[Depends(rate_limited("analyze"))])
 async def analyze(req: AnalysisRequest):
     try:
-        client = AzureOpenAI(
-            api_version=os.getenv("OPENAI_API_VERSION", "2025-01-01-preview"),
-            azure_endpoint=os.getenv("OPENAI_API_BASE"),
-            api_key=os.getenv("OPENAI_API_KEY")
-        )
+        result, cached, usage = await complete_analysis(req)
+        if cached:
+            return {"result": result, "cached": True, "usage": usage}
+        return {"result": result, "usage": usage}
 
-        completion = client.chat.completions.create(
-            model=os.getenv("OPENAI_MODEL", "gpt-4o-3"),
-            messages=[
-                {"role": "system", "content": "あなたは百戦錬磨の優秀な地方中小企業の経営コンサルタントです。"},
-                {"role": "user", "content": req.prompt}
-            ],
-            temperature=1.0,
-            top_p=1.0,
-            max_tokens=2048  # 🔧 応答長を確保
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return JSONResponse(status_code=500, content={"error": f"Internal Server Error: {str(e)}"})
+
+# ============================
+# 📡 経営分析API（ストリーミング / SSE）
+# ============================
+def sse_event(data: dict, event: str = None) -> str:
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+@app.post("/api/analyze/stream", dependencies=[Depends(rate_limited("analyze"))])
+async def analyze_stream(req: AnalysisRequest, request: Request):
+    async def event_stream():
+        # 接続直後にコメント行を送り、プロキシやブラウザに即座にヘッダーを届ける
+        yield ": stream-open\n\n"
+        plan = prepare_analysis(req)
+        cache_key = analysis_cache_key(req, plan)
+        if cache_key:
+            cached = await analysis_cache.get(cache_key)
+            if cached is not None:
+                yield sse_event({"delta": cached, "cached": True})
+                yield sse_event({"status": "done", "usage": plan["usage"]}, event="done")
+                return
+
+        messages = plan["messages"]
+        async with deployment_slot(OPENAI_DEPLOYMENT):
+            stream = None
+            parts = []
+            used_tokens = None
+            try:
+                with trace_span("openai_completion_stream_open"):
+                    stream = await call_openai_with_budget(
+                        lambda: get_chat_client().chat.completions.create(
+                            model=OPENAI_DEPLOYMENT,
+                            messages=messages,
+                            stream=True,
+                            stream_options={"include_usage": True},  # 最後のチャンクで usage を受け取り予約を精算する
+                            **plan["params"]
+                        ),
+                        messages,
+                        plan["params"]["max_tokens"],
+                    )
+                async for chunk in stream:
+                    # クライアントが離脱したら上流のストリームも打ち切る
+                    if await request.is_disconnected():
+                        print("⚠️ クライアント切断のため分析ストリームを中断しました")
+                        return
+                    if getattr(chunk, "usage", None) is not None:
+                        used_tokens = chunk.usage.total_tokens
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield sse_event({"delta": delta})
+                if cache_key and parts:
+                    await analysis_cache.set(cache_key, "".join(parts))
+                usage = {**plan["usage"], "completion_tokens": count_tokens("".join(parts))}
+                yield sse_event({"status": "done", "usage": usage}, event="done")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                yield sse_event({"error": f"Internal Server Error: {str(e)}"}, event="error")
+            finally:
+                if stream is not None:
+                    await stream.response.aclose()
+                    if used_tokens is None:
+                        # 途中で切れた・usage が返らなかった場合は、手元で数えたトークン数で精算する
+                        used_tokens = plan["usage"]["prompt_tokens"] + count_tokens("".join(parts))
+                    openai_budget.settle(openai_reservation(messages, plan["params"]["max_tokens"]), used_tokens)
+
+    return TrackedStreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # リバースプロキシでのバッファリングを無効化
+        },
+    )
+
+# ============================
+# 📦 経営分析API（バッチ / NDJSON）
+# ============================
+# 複数のプロンプト（または店舗 ID）を同時に Azure OpenAI へ投げ、終わった順に 1 行ずつ返す。
+# 同時実行数は deployment_slot、毎分のリクエスト数・トークン数は openai_budget で抑える。
+ANALYSIS_BATCH_MAX_ITEMS = int(os.getenv("ANALYSIS_BATCH_MAX_ITEMS", 200))
+STORE_ANALYSIS_INSTRUCTION = "この回答から読み取れる経営課題と、優先して取り組むべき施策を具体的に提案してください。"
+
+def diagnosis_key_order(key: str) -> tuple:
+    # "セクション-設問" を数値順に並べる（形式外のキーは末尾）
+    parsed = parse_question_key(key)
+    return (0, *parsed, "") if parsed else (1, 0, 0, str(key))
+
+def build_store_prompt(store_id: int, answers: dict, instruction: Optional[str] = None, scores: Optional[dict] = None) -> str:
+    lines = [f"{key}: {answers[key]}" for key in sorted(answers, key=diagnosis_key_order)]
+    summary = ""
+    if scores:
+        # 事前計算したスコアを添えて、モデルに数値の集計をさせない
+        sections = " / ".join(
+            f"{s['section']}: {s['score']}点（p{s['percentile']}）" for s in scores["sections"] if s["score"] is not None
+        )
+        summary = (
+            f"スコア（0〜100、p は全 {scores['stores']} 店舗中のパーセンタイル）: "
+            f"全体 {scores['overall']['score']}点（p{scores['overall']['percentile']}） / {sections}\n\n"
         )
-        return {"result": completion.choices[0].message.content}
+    return (
+        f"店舗ID {store_id} の経営診断アンケートの回答です（キーは「セクション-設問」）。\n"
+        + "\n".join(lines)
+        + "\n\n"
+        + summary
+        + (instruction or STORE_ANALYSIS_INSTRUCTION)
+    )
 
+async def run_batch_item(index: int, no_cache: bool, prompt: str = None, store_id: int = None,
+                         instruction: str = None) -> dict:
+    item = {"index": index}
+    if store_id is not None:
+        item["store_id"] = store_id
+    started = time.perf_counter()
+    try:
+        if store_id is not None:
+            latest = await run_in_threadpool(load_latest_diagnosis_answers, store_id)
+            if not latest["answers"]:
+                item["error"] = "診断回答がありません"
+                return item
+            scores = await run_in_threadpool(diagnosis_scores.store_scores, store_id)
+            prompt = build_store_prompt(store_id, latest["answers"], instruction, scores)
+        result, cached, usage = await complete_analysis(AnalysisRequest(prompt=prompt, no_cache=no_cache))
+        item.update({"result": result, "cached": cached, "usage": usage})
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return JSONResponse(status_code=500, content={"error": f"Internal Server Error: {str(e)}"})
+        item["error"] = f"Internal Server Error: {str(e)}"
+    item["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return item
+
+@app.post("/api/analyze/batch", dependencies=[Depends(rate_limited("analyze_batch"))])
+async def analyze_batch(req: BatchAnalysisRequest, request: Request):
+    total = len(req.prompts) + len(req.store_ids)
+    if total == 0:
+        return JSONResponse(status_code=400, content={"error": "prompts か store_ids を指定してください"})
+    if total > ANALYSIS_BATCH_MAX_ITEMS:
+        return JSONResponse(status_code=400, content={"error": f"一度に分析できるのは {ANALYSIS_BATCH_MAX_ITEMS} 件までです"})
+
+    async def ndjson_stream():
+        # index は prompts → store_ids の順に振る
+        tasks = [
+            asyncio.create_task(run_batch_item(i, req.no_cache, prompt=prompt))
+            for i, prompt in enumerate(req.prompts)
+        ]
+        tasks += [
+            asyncio.create_task(run_batch_item(len(req.prompts) + i, req.no_cache, store_id=store_id, instruction=req.instruction))
+            for i, store_id in enumerate(req.store_ids)
+        ]
+        started = time.perf_counter()
+        failed = 0
+        try:
+            for finished in asyncio.as_completed(tasks):
+                item = await finished
+                failed += "error" in item
+                # クライアントが離脱したら残りの呼び出しを取り消してクォータを無駄にしない
+                if await request.is_disconnected():
+                    print("⚠️ クライアント切断のためバッチ分析を中断しました")
+                    return
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+            yield json.dumps({
+                "status": "done",
+                "total": total,
+                "failed": failed,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            }, ensure_ascii=False) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return TrackedStreamingResponse(
+        ndjson_stream(),
+        media_type="application/x-ndjson",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
 
 # ================================
 # 🖼 SNSキャンペーン画像生成API
 # ================================
-@app.post("/api/generate-campaign-image")
+DALLE_IMAGE_PARAMS = {
+    "size": "1024x1024",
+    "quality": "hd",  # 🎯 高精細な画像生成を要求
+    "n": 1,
+}
+
+async def generate_dalle_image(prompt: str) -> str:
+    # 生成された画像の（期限付きの）URL を返す
+    async with deployment_slot(DALLE_DEPLOYMENT):
+        with trace_span("dalle_generate"):
+            response = await get_dalle_client().images.generate(
+                model=DALLE_DEPLOYMENT,
+                prompt=prompt,
+                **DALLE_IMAGE_PARAMS
+            )
+    return response.data[0].url
+
+@app.post("/api/generate-campaign-image", dependencies=[Depends(rate_limited("image"))])
 async def generate_campaign_image(req: ImageRequest):
     try:
-        dalle_client = AzureOpenAI(
-            api_key=os.getenv("DALLE_API_KEY"),
-            api_version=os.getenv("DALLE_API_VERSION", "2024-02-01"),
-            azure_endpoint=os.getenv("DALLE_API_BASE")
-        )
-
-        response = dalle_client.images.generate(
-            model=os.getenv("DALLE_DEPLOYMENT_NAME", "dall-e-3"),
-            prompt=req.analysis_summary,
-            size="1024x1024",
-            quality="hd",  # 🎯 高精細な画像生成を要求
-            n=1
+        # 生成済みのプロンプトなら課金せずに保存済みの画像を返す（/api/image-jobs と共有）
+        prompt_hash = image_prompt_hash(req.analysis_summary)
+        stored = await run_in_threadpool(load_generated_image, prompt_hash)
+        if stored:
+            return {"image_url": stored["image_url"]}
+        # ダブルクリックなどで同じプロンプトが同時に来たら 1 回の生成を共有する
+        image_url = await request_flights.do(
+            "image:" + prompt_hash,
+            lambda: generate_and_store_image(req.analysis_summary, prompt_hash),
         )
-
-        image_url = response.data[0].url
         return {"image_url": image_url}
 
     except Exception as e:
         print("❌ Image Generation Error:", str(e))
         return JSONResponse(status_code=500, content={"error": f"画像生成エラー: {str(e)}"})
         
+# ================================
+# 🔑 Instaloader セッションプール
+# ================================
+# ログイン済みのコンテキストを使い回し、セッションはディスクに保存して起動時に読み込む。
+# アカウントごとに 1 時間あたりのリクエスト予算を持ち（Instagram への実リクエスト単位で数える）、
+# レート制限を受けたら全体で待機する。
+INSTAGRAM_SESSION_DIR = os.getenv("INSTAGRAM_SESSION_DIR", os.path.join(os.path.dirname(__file__), ".instaloader-sessions"))
+INSTAGRAM_ACCOUNT_HOURLY_BUDGET = int(os.getenv("INSTAGRAM_ACCOUNT_HOURLY_BUDGET", 150))
+INSTAGRAM_ANONYMOUS_CONTEXTS = int(os.getenv("INSTAGRAM_ANONYMOUS_CONTEXTS", 2))
+INSTAGRAM_LEASE_TIMEOUT = float(os.getenv("INSTAGRAM_LEASE_TIMEOUT", 30))  # 空きコンテキスト待ちの上限（秒）
+INSTAGRAM_BACKOFF_BASE = int(os.getenv("INSTAGRAM_BACKOFF_BASE", 60))  # 秒
+INSTAGRAM_BACKOFF_MAX = int(os.getenv("INSTAGRAM_BACKOFF_MAX", 60 * 60))  # 秒
+
+class InstagramUnavailable(Exception):
+    pass
+
+class InstagramBudgetExceeded(InstagramUnavailable):
+    pass
+
+def instagram_accounts() -> list:
+    # INSTAGRAM_ACCOUNTS="user1:pass1,user2:pass2"（未設定なら INSTAGRAM_USERNAME / INSTAGRAM_PASSWORD）
+    accounts = []
+    for entry in os.getenv("INSTAGRAM_ACCOUNTS", "").split(","):
+        if ":" in entry:
+            username, password = entry.strip().split(":", 1)
+            accounts.append((username, password))
+    if not accounts and os.getenv("INSTAGRAM_USERNAME") and os.getenv("INSTAGRAM_PASSWORD"):
+        accounts.append((os.getenv("INSTAGRAM_USERNAME"), os.getenv("INSTAGRAM_PASSWORD")))
+    return accounts
+
+class InstaloaderSlot:
+    def __init__(self, username: str = None, password: str = None):
+        self.username = username  # None は匿名コンテキスト
+        self.password = password
+        from instaloader import Instaloader
+        self.loader = Instaloader(quiet=True, rate_controller=budgeted_rate_controller(self))
+        self.logged_in = False
+        self.leased_at = None
+        self.request_times = deque()
+        self._budget_lock = threading.Lock()  # 貸出先のスレッドとプールの両方から触る
+        self.backoff_until = 0.0
+        self.failures = 0
+
+    @property
+    def session_file(self) -> str:
+        return os.path.join(INSTAGRAM_SESSION_DIR, f"session-{self.username}")
+
+    def _expire(self, now: float):
+        while self.request_times and now - self.request_times[0] > 3600:
+            self.request_times.popleft()
+
+    def remaining_budget(self, now: float) -> int:
+        with self._budget_lock:
+            self._expire(now)
+            return INSTAGRAM_ACCOUNT_HOURLY_BUDGET - len(self.request_times)
+
+    def take_request(self, now: float) -> bool:
+        # 匿名コンテキストは予算なし（Instagram 側のレート制限とバックオフに任せる）
+        if self.username is None:
+            return True
+        with self._budget_lock:
+            self._expire(now)
+            if len(self.request_times) >= INSTAGRAM_ACCOUNT_HOURLY_BUDGET:
+                return False
+            self.request_times.append(now)
+            return True
+
+def budgeted_rate_controller(slot: InstaloaderSlot):
+    from instaloader import RateController
+
+    class BudgetedRateController(RateController):
+        # Instaloader が Instagram にリクエストする直前に毎回呼ばれる。予算が尽きていれば送らずに打ち切る
+        def wait_before_query(self, query_type: str) -> None:
+            if not slot.take_request(time.time()):
+                raise InstagramBudgetExceeded(f"Instagram アカウント {slot.username} の 1 時間あたりのリクエスト上限に達しました")
+            super().wait_before_query(query_type)
+
+    return BudgetedRateController
+
+class InstaloaderPool:
+    def __init__(self):
+        self._slots = []
+        self._cond = threading.Condition()
+        self._loaded = False
+        self.global_backoff_until = 0.0
+
+    def load_sessions(self):
+        with self._cond:
+            if self._loaded:
+                return
+            slots = [InstaloaderSlot() for _ in range(INSTAGRAM_ANONYMOUS_CONTEXTS)]
+            for username, password in instagram_accounts():
+                slot = InstaloaderSlot(username, password)
+                if os.path.exists(slot.session_file):
+                    try:
+                        slot.loader.load_session_from_file(username, slot.session_file)
+                        slot.logged_in = True
+                    except Exception as e:
+                        print(f"⚠️ Instagram セッション読込失敗 ({username}):", str(e))
+                slots.append(slot)
+            self._slots = slots
+            self._loaded = True
+
+    def _pick(self, login_required: bool, now: float, account: Optional[str] = None):
+        candidates = []
+        for slot in self._slots:
+            if account is not None and slot.username != account:
+                continue
+            if slot.leased_at is not None:
+                continue  # 貸出中のコンテキストは長時間でも回収しない（スレッド間で共有させない）
+            if slot.backoff_until > now:
+                continue
+            if slot.username is None:
+                if login_required:
+                    continue
+                candidates.append((0, 0, slot))  # ログイン不要なら匿名を優先してアカウント予算を温存
+            elif slot.remaining_budget(now) > 0:
+                candidates.append((1, -slot.remaining_budget(now), slot))
+        if not candidates:
+            return None
+        return min(candidates, key=lambda c: (c[0], c[1]))[2]
+
+    def acquire(self, login_required: bool = False, timeout: float = INSTAGRAM_LEASE_TIMEOUT,
+                account: Optional[str] = None) -> InstaloaderSlot:
+        # account を指定すると、そのアカウントのコンテキストが空くまで待つ（続きから再開するエクスポート用）
+        self.load_sessions()
+        if login_required and not any(slot.username for slot in self._slots):
+            raise ValueError("INSTAGRAM_USERNAME または INSTAGRAM_PASSWORD が未設定です")
+
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                if self.global_backoff_until <= now:
+                    slot = self._pick(login_required, now, account)
+                    if slot is not None:
+                        slot.leased_at = now
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise InstagramUnavailable("Instagram のリクエスト上限に達しています。時間をおいて再試行してください")
+                self._cond.wait(min(remaining, 1.0))
+
+        if login_required and not slot.logged_in:
+            try:
+                slot.loader.login(slot.username, slot.password)
+                os.makedirs(INSTAGRAM_SESSION_DIR, exist_ok=True)
+                slot.loader.save_session_to_file(slot.session_file)
+                slot.logged_in = True
+            except Exception as e:
+                self.release(slot, e)
+                raise
+        return slot
+
+    def release(self, slot: InstaloaderSlot, error: Exception = None):
+        from instaloader.exceptions import ConnectionException, LoginException, LoginRequiredException, TooManyRequestsException
+
+        with self._cond:
+            slot.leased_at = None
+            if error is None:
+                slot.failures = 0
+            elif isinstance(error, LoginRequiredException):
+                slot.logged_in = False  # セッション切れ。次回貸出時に再ログイン
+            elif isinstance(error, (TooManyRequestsException, ConnectionException, LoginException)):
+                # 指数バックオフ。ログイン失敗（パスワード誤り・2 段階認証・チェックポイント）も
+                # すぐに再ログインするとアカウントの確認要求を招くので、同じように間を空ける。
+                # レート制限はアカウントを問わず全体でも少し待つ
+                slot.failures += 1
+                delay = min(INSTAGRAM_BACKOFF_BASE * 2 ** (slot.failures - 1), INSTAGRAM_BACKOFF_MAX)
+                slot.backoff_until = time.time() + delay
+                if isinstance(error, TooManyRequestsException):
+                    self.global_backoff_until = max(self.global_backoff_until, time.time() + INSTAGRAM_BACKOFF_BASE)
+            self._cond.notify_all()
+
+    @contextmanager
+    def lease(self, login_required: bool = False):
+        slot = self.acquire(login_required)
+        try:
+            yield slot.loader
+        except Exception as e:
+            self.release(slot, e)
+            raise
+        else:
+            self.release(slot)
+
+    def status(self) -> list:
+        now = time.time()
+        with self._cond:
+            return [
+                {
+                    "account": slot.username or "anonymous",
+                    "logged_in": slot.logged_in,
+                    "leased": slot.leased_at is not None,
+                    "leased_seconds": round(now - slot.leased_at) if slot.leased_at is not None else None,
+                    "remaining_budget": slot.remaining_budget(now) if slot.username else None,
+                    "backoff_seconds": max(0, round(slot.backoff_until - now)),
+                }
+                for slot in self._slots
+            ]
+
+instaloader_pool = InstaloaderPool()
+
+@app.get("/api/instagram-pool")
+async def instagram_pool_status():
+    return {
+        "global_backoff_seconds": max(0, round(instaloader_pool.global_backoff_until - time.time())),
+        "contexts": instaloader_pool.status(),
+    }
+
 # ================================
 # 🖼 SNS投稿データ
 # ================================
-from azure.storage.blob import BlobServiceClient, ContentSettings
-import requests
-import uuid
+INSTAGRAM_JOB_WORKERS = int(os.getenv("INSTAGRAM_JOB_WORKERS", 4))  # 同時に処理する投稿数
+INSTAGRAM_JOB_QUEUE_SIZE = int(os.getenv("INSTAGRAM_JOB_QUEUE_SIZE", 500))
+INSTAGRAM_JOB_TTL = int(os.getenv("INSTAGRAM_JOB_TTL", 60 * 60))  # 完了ジョブを保持する秒数
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", 30))  # 秒
+IMAGE_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+INSTAGRAM_POST_STALE_SECONDS = int(os.getenv("INSTAGRAM_POST_STALE_SECONDS", 60 * 60))  # いいね・コメント数を再取得するまでの秒数
+
+class InvalidPostURL(ValueError):
+    pass
+
+async_blob_service_client = None
+download_client = None
+
+def get_async_blob_service_client() -> "AsyncBlobServiceClient":
+    global async_blob_service_client
+    if async_blob_service_client is None:
+        from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+
+        azure_connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        if not azure_connection_string:
+            raise ValueError("❌ AZURE_STORAGE_CONNECTION_STRING が設定されていません")
+        async_blob_service_client = AsyncBlobServiceClient.from_connection_string(azure_connection_string)
+    return async_blob_service_client
+
+def get_download_client() -> httpx.AsyncClient:
+    global download_client
+    if download_client is None:
+        download_client = httpx.AsyncClient(timeout=IMAGE_DOWNLOAD_TIMEOUT, follow_redirects=True)
+    return download_client
+
+def blob_public_url(container: str, blob_name: str) -> str:
+    return f"https://{get_async_blob_service_client().account_name}.blob.core.windows.net/{container}/{blob_name}"
+
+def extract_shortcode(url: str) -> str:
+    # Instagram URL から shortcode を抽出
+    shortcode_match = re.search(r"/p/([^/?#&]+)", url)
+    if not shortcode_match:
+        raise InvalidPostURL("URLが正しくありません")
+    return shortcode_match.group(1)
+
+def fetch_post_metadata(shortcode: str, with_followers: bool = False) -> dict:
+    # Instaloader は同期 API のためスレッドプールから呼び出す
+    import instaloader
+
+    with instaloader_pool.lease() as loader, trace_span("instaloader_fetch"):
+        post_data = instaloader.Post.from_shortcode(loader.context, shortcode)
+        metadata = {
+            "image_url": post_data.url,
+            "caption": post_data.caption,
+            "likes": post_data.likes,
+            "comments": post_data.comments,
+            "owner_username": post_data.owner_username,
+            "owner_followers": None,
+        }
+        if with_followers:
+            # フォロワー数はプロフィールの追加リクエストになるので、キャンペーン投稿のときだけ取る
+            metadata["owner_followers"] = load_owner_followers(post_data.owner_profile)
+        return metadata
 
-@app.post("/api/fetch-instagram-post")
+def load_owner_followers(profile) -> Optional[int]:
+    # エンゲージメント率の分母。取れなくても投稿の取り込みは失敗させず、未取得として扱う
+    try:
+        with trace_span("instaloader_profile"):
+            return profile.followers
+    except Exception as e:
+        print(f"⚠️ フォロワー数の取得失敗 ({getattr(profile, 'username', '?')}):", str(e))
+        return None
+
+def fetch_owner_followers(username: str) -> Optional[int]:
+    from instaloader import Profile
+
+    try:
+        with instaloader_pool.lease() as loader, trace_span("instaloader_profile"):
+            return Profile.from_username(loader.context, username).followers
+    except Exception as e:
+        print(f"⚠️ フォロワー数の取得失敗 ({username}):", str(e))
+        return None
+
+def is_campaign_post(shortcode: str) -> bool:
+    with engine.connect() as conn:
+        return conn.execute(
+            select(CampaignPost.id).where(CampaignPost.shortcode == shortcode).limit(1)
+        ).first() is not None
+
+def save_owner_followers(shortcode: str, followers: int):
+    with engine.begin() as conn:
+        conn.execute(
+            InstagramPost.__table__.update()
+            .where(InstagramPost.shortcode == shortcode)
+            .values(owner_followers=followers)
+        )
+
+async def stream_to_blob(source_url: str, container: str, blob_name: str, content_type: str, hasher=None) -> str:
+    # 画像全体をメモリに溜めず、ダウンロードしたチャンクをそのまま Blob に流し込む
+    from azure.storage.blob import ContentSettings
+
+    blob_client = get_async_blob_service_client().get_blob_client(container=container, blob=blob_name)
+
+    # ダウンロードとアップロードは並行して流れるため、
+    # image_download はレスポンスヘッダー受信まで、blob_upload は本体の転送と確定までを計測する
+    async with AsyncExitStack() as stack:
+        with trace_span("image_download"):
+            response = await stack.enter_async_context(get_download_client().stream("GET", source_url))
+            response.raise_for_status()
+
+        async def chunks():
+            async for chunk in response.aiter_bytes(IMAGE_DOWNLOAD_CHUNK_SIZE):
+                if hasher is not None:
+                    hasher.update(chunk)
+                yield chunk
+
+        with trace_span("blob_upload"):
+            await blob_client.upload_blob(
+                chunks(),
+                overwrite=True,
+                blob_type="BlockBlob",
+                content_settings=ContentSettings(content_type=content_type)
+            )
+    return blob_public_url(container, blob_name)
+
+# ================================
+# 🖼 投稿画像のサイズ別バリアント（サムネイル / カード / フル）
+# ================================
+# 元画像をそのまま配信せず、サイズ別に縮小して WebP と JPEG（WebP 非対応ブラウザ向け）で保存する。
+# EXIF などのメタデータは再エンコードで落とす。デコード・縮小・エンコードはイベントループを塞がないよう
+# 専用のプロセスプールで行う。Blob 名は内容ハッシュから決まり中身が変わらないので、長期キャッシュさせる。
+IMAGE_VARIANTS = {"thumb": 320, "card": 640, "full": 1440}  # 名前 -> 長辺の最大ピクセル
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", 80))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 82))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 20 * 1024 * 1024))  # これを超える元画像は取り込まない
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", max(1, (os.cpu_count() or 1) // 2)))
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+image_executor = None
+
+def get_image_executor():
+    global image_executor
+    if image_executor is None:
+        if IMAGE_PROCESS_WORKERS > 1 and (os.cpu_count() or 1) > 1:
+            image_executor = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+        else:
+            image_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-process")
+    return image_executor
+
+def shutdown_image_executor():
+    if image_executor is not None:
+        image_executor.shutdown(wait=False, cancel_futures=True)
+
+def render_image_variants(data: bytes) -> dict:
+    # プロセスプール上で実行する（引数・戻り値はバイト列と数値だけ）
+    from PIL import Image, ImageOps
+
+    variants = {}
+    with Image.open(io.BytesIO(data)) as source:
+        largest = max(IMAGE_VARIANTS.values())
+        source.draft("RGB", (largest, largest))  # JPEG は縮小しながらデコードして速くする
+        image = ImageOps.exif_transpose(source).convert("RGB")  # 向きを反映してから EXIF ごと捨てる
+    for name, size in IMAGE_VARIANTS.items():
+        variant = image.copy()
+        variant.thumbnail((size, size), Image.LANCZOS)
+        webp, jpeg = io.BytesIO(), io.BytesIO()
+        variant.save(webp, "WEBP", quality=IMAGE_WEBP_QUALITY, method=4)
+        variant.save(jpeg, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True)
+        variants[name] = {"webp": webp.getvalue(), "jpeg": jpeg.getvalue(), "width": variant.width, "height": variant.height}
+    return variants
+
+async def download_image(source_url: str, hasher) -> bytes:
+    # 加工には画像全体が必要なのでメモリに読む（上限つき）。内容ハッシュは受信しながら計算する
+    buffer = bytearray()
+    with trace_span("image_download"):
+        async with get_download_client().stream("GET", source_url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(IMAGE_DOWNLOAD_CHUNK_SIZE):
+                buffer.extend(chunk)
+                hasher.update(chunk)
+                if len(buffer) > IMAGE_MAX_BYTES:
+                    raise ValueError(f"画像が大きすぎます（上限 {IMAGE_MAX_BYTES} バイト）")
+    return bytes(buffer)
+
+async def upload_bytes(container: str, blob_name: str, data: bytes, content_type: str, cache_control: str = None) -> str:
+    from azure.storage.blob import ContentSettings
+
+    blob_client = get_async_blob_service_client().get_blob_client(container=container, blob=blob_name)
+    await blob_client.upload_blob(
+        data,
+        overwrite=True,
+        blob_type="BlockBlob",
+        content_settings=ContentSettings(content_type=content_type, cache_control=cache_control),
+    )
+    return blob_public_url(container, blob_name)
+
+async def store_image_variants(data: bytes, content_hash: str) -> Optional[dict]:
+    # バリアントを作ってアップロードし、{名前: {webp, jpeg, width, height}} を返す。画像として読めなければ None
+    loop = asyncio.get_running_loop()
+    try:
+        with trace_span("image_process"):
+            rendered = await loop.run_in_executor(get_image_executor(), render_image_variants, data)
+    except ImportError:
+        print("⚠️ Pillow が未インストールのため画像を加工せずに保存します")
+        return None
+    except Exception as e:
+        print("⚠️ 画像を加工できないため元画像のまま保存します:", str(e))
+        return None
+
+    uploads = []
+    variants = {}
+    for name, variant in rendered.items():
+        variants[name] = {"width": variant["width"], "height": variant["height"]}
+        for fmt, content_type in (("webp", "image/webp"), ("jpeg", "image/jpeg")):
+            blob_name = f"variants/{content_hash}/{name}.{'jpg' if fmt == 'jpeg' else fmt}"
+            variants[name][fmt] = blob_public_url(container_name, blob_name)
+            uploads.append(upload_bytes(container_name, blob_name, variant[fmt], content_type, IMAGE_CACHE_CONTROL))
+    with trace_span("blob_upload"):
+        await asyncio.gather(*uploads)
+    return variants
+
+def instagram_post_to_dict(row: InstagramPost) -> dict:
+    return {
+        "shortcode": row.shortcode,
+        "blob_name": row.blob_name,
+        "image_url": row.image_url,
+        "content_hash": row.content_hash,
+        "caption": row.caption,
+        "likes": row.likes,
+        "comments": row.comments,
+        "owner_username": row.owner_username,
+        "owner_followers": row.owner_followers,
+        "variants": json.loads(row.variants) if row.variants else None,
+        "fetched_at": row.fetched_at,
+    }
+
+def load_instagram_post(shortcode: str = None, content_hash: str = None):
+    db = SessionLocal()
+    try:
+        if shortcode is not None:
+            row = db.get(InstagramPost, shortcode)
+        else:
+            row = db.query(InstagramPost).filter(InstagramPost.content_hash == content_hash).first()
+        return instagram_post_to_dict(row) if row else None
+    finally:
+        db.close()
+
+def save_instagram_post(shortcode: str, metadata: dict, blob_name: str, image_url: str, content_hash: str,
+                        variants: Optional[dict] = None) -> dict:
+    db = SessionLocal()
+    try:
+        row = db.merge(InstagramPost(
+            shortcode=shortcode,
+            blob_name=blob_name,
+            image_url=image_url,
+            content_hash=content_hash,
+            variants=json.dumps(variants) if variants else None,
+            caption=metadata["caption"],
+            likes=metadata["likes"],
+            comments=metadata["comments"],
+            owner_username=metadata["owner_username"],
+            owner_followers=metadata["owner_followers"],
+            fetched_at=datetime.utcnow(),
+        ))
+        post = instagram_post_to_dict(row)  # commit 後の再読込を避けるため先に取り出す
+        db.commit()
+    finally:
+        db.close()
+
+    # この投稿を含むキャンペーンの集計にも最新の指標を反映する
+    refresh_campaign_posts(post)
+    return post
+
+def instagram_post_response(post: dict, cached: bool) -> dict:
+    # 投稿情報とアップロードした画像URLを返す
+    return {
+        "image_url": post["image_url"],
+        "variants": post["variants"],  # サイズ別の WebP / JPEG（一覧やカードには thumb / card を使う）
+        "caption": post["caption"],
+        "likes": post["likes"],
+        "comments": post["comments"],
+        "fetched_at": post["fetched_at"],
+        "cached": cached,
+    }
+
+async def ingest_instagram_post(url: str) -> dict:
+    post, cached = await ingest_instagram_post_record(url)
+    return instagram_post_response(post, cached)
+
+async def ingest_instagram_post_record(url: str):
+    # (投稿レコード, キャッシュから返したか) を返す。同じ投稿の同時取り込みは 1 回にまとめる
+    shortcode = extract_shortcode(url)
+    return await request_flights.do("instagram:" + shortcode, lambda: ingest_instagram_shortcode(shortcode))
+
+async def ingest_instagram_shortcode(shortcode: str):
+    # 取り込み済みで鮮度内ならインデックスから返す
+    known = await run_in_threadpool(load_instagram_post, shortcode)
+    if known and known["fetched_at"] and datetime.utcnow() - known["fetched_at"] < timedelta(seconds=INSTAGRAM_POST_STALE_SECONDS):
+        return known, True
+
+    # Instaloaderで投稿情報取得（キャンペーン集計中の投稿を更新するときだけフォロワー数も取り直す）
+    with_followers = bool(known) and await run_in_threadpool(is_campaign_post, shortcode)
+    metadata = await run_in_threadpool(fetch_post_metadata, shortcode, with_followers)
+    if known and metadata["owner_followers"] is None:
+        metadata["owner_followers"] = known["owner_followers"]  # 取れなければ前回の値を使い続ける
+
+    if known:
+        # 鮮度切れはカウンターだけ更新し、保存済みの画像 Blob を使い回す
+        refreshed = await run_in_threadpool(
+            save_instagram_post, shortcode, metadata, known["blob_name"], known["image_url"], known["content_hash"],
+            known["variants"]
+        )
+        return refreshed, True
+
+    # 画像を取得（受信しながら内容ハッシュを計算）
+    hasher = hashlib.sha256()
+    data = await download_image(metadata["image_url"], hasher)
+    content_hash = hasher.hexdigest()
+
+    # 同じ画像が別の shortcode で保存済みなら、加工もアップロードもせず既存を参照する
+    duplicate = await run_in_threadpool(load_instagram_post, None, content_hash)
+    if duplicate:
+        saved = await run_in_threadpool(
+            save_instagram_post, shortcode, metadata, duplicate["blob_name"], duplicate["image_url"], content_hash,
+            duplicate["variants"]
+        )
+        return saved, False
+
+    # サイズ別のバリアントを作って保存する。image_url は互換のためフルサイズの JPEG を指す
+    variants = await store_image_variants(data, content_hash)
+    if variants:
+        blob_name = f"variants/{content_hash}/full.jpg"
+        image_url = variants["full"]["jpeg"]
+    else:
+        blob_name = f"{shortcode}_{uuid.uuid4().hex}.jpg"
+        with trace_span("blob_upload"):
+            image_url = await upload_bytes(container_name, blob_name, data, "image/jpeg")
+
+    saved = await run_in_threadpool(save_instagram_post, shortcode, metadata, blob_name, image_url, content_hash, variants)
+    return saved, False
+
+@app.post("/api/fetch-instagram-post", dependencies=[Depends(rate_limited("instagram"))])
 async def fetch_instagram_post(post: PostURL):
     try:
-        # Instagram URL から shortcode を抽出
-        shortcode_match = re.search(r"/p/([^/?#&]+)", post.url)
-        if not shortcode_match:
-            return JSONResponse(status_code=400, content={"error": "URLが正しくありません"})
+        return await ingest_instagram_post(post.url)
+    except InvalidPostURL as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except InstagramUnavailable as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
 
-        shortcode = shortcode_match.group(1)
+# ================================
+# 🧵 SNS投稿取り込みジョブ（バックグラウンドワーカー）
+# ================================
+# ジョブの状態は DB に置き、キューには受け付けたワーカー自身が処理する job_id と URL だけを積む
+instagram_job_queue = None
+instagram_job_workers = []
 
-        # Instaloaderで投稿情報取得
-        loader = instaloader.Instaloader()
-        post_data = instaloader.Post.from_shortcode(loader.context, shortcode)
+def instagram_job_dict(job: InstagramJob) -> dict:
+    return {
+        "job_id": job.job_id, "url": job.url, "status": job.status,
+        "result": json.loads(job.result) if job.result else None, "error": job.error,
+        "created_at": job.created_at, "finished_at": job.finished_at,
+    }
 
-        # 画像URL取得
-        image_url = post_data.url
+def save_instagram_jobs(jobs: List[dict]):
+    db = SessionLocal()
+    try:
+        db.query(InstagramJob).filter(
+            InstagramJob.finished_at < time.time() - INSTAGRAM_JOB_TTL
+        ).delete(synchronize_session=False)
+        db.add_all([InstagramJob(**job) for job in jobs])
+        db.commit()
+    finally:
+        db.close()
+
+def update_instagram_jobs(job_ids: List[str], **fields):
+    db = SessionLocal()
+    try:
+        db.query(InstagramJob).filter(InstagramJob.job_id.in_(job_ids)).update(fields, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
 
-        # 画像を取得（バイナリ）
-        img_data = requests.get(image_url).content
-        filename = f"{shortcode}_{uuid.uuid4().hex}.jpg"
+def load_instagram_job(job_id: str):
+    db = SessionLocal()
+    try:
+        job = db.get(InstagramJob, job_id)
+        return instagram_job_dict(job) if job else None
+    finally:
+        db.close()
+
+async def instagram_job_worker():
+    while True:
+        job_id, url = await instagram_job_queue.get()
+        try:
+            await run_in_threadpool(update_instagram_jobs, [job_id], status="running")
+            result = await ingest_instagram_post(url)
+            await run_in_threadpool(
+                update_instagram_jobs, [job_id],
+                status="done", result=json.dumps(jsonable_encoder(result), ensure_ascii=False), finished_at=time.time()
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            try:
+                await run_in_threadpool(update_instagram_jobs, [job_id], status="error", error=str(e), finished_at=time.time())
+            except Exception as db_error:
+                print(f"❌ ジョブ {job_id} の状態を保存できませんでした: {db_error}")
+        finally:
+            instagram_job_queue.task_done()
+
+async def start_instagram_job_workers():
+    global instagram_job_queue
+    instagram_job_queue = asyncio.Queue(maxsize=INSTAGRAM_JOB_QUEUE_SIZE)
+    for _ in range(INSTAGRAM_JOB_WORKERS):
+        instagram_job_workers.append(asyncio.create_task(instagram_job_worker()))
+
+async def stop_instagram_job_workers():
+    for task in instagram_job_workers:
+        task.cancel()
+    await asyncio.gather(*instagram_job_workers, return_exceptions=True)
+    instagram_job_workers.clear()
+
+async def close_blob_clients():
+    global async_blob_service_client, download_client
+    if async_blob_service_client is not None:
+        await async_blob_service_client.close()
+        async_blob_service_client = None
+    if download_client is not None:
+        await download_client.aclose()
+        download_client = None
+
+@app.post("/api/instagram-jobs", status_code=202, dependencies=[Depends(rate_limited("instagram"))])
+async def create_instagram_jobs(req: InstagramJobRequest):
+    jobs = []
+    for url in req.urls:
+        job = {"job_id": uuid.uuid4().hex, "url": url, "status": "queued", "created_at": time.time()}
+        try:
+            extract_shortcode(url)
+        except InvalidPostURL as e:
+            job.update(status="error", error=str(e), finished_at=time.time())
+        jobs.append(job)
 
-        # Azure Storage へアップロード
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=filename)
-        blob_client.upload_blob(
-            img_data,
-            overwrite=True,
-            blob_type="BlockBlob",
-            content_settings=ContentSettings(content_type="image/jpeg")
+    # ワーカーが状態を更新できるよう、行を作ってからキューに積む
+    try:
+        await run_in_threadpool(save_instagram_jobs, jobs)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    rejected = []
+    for job in jobs:
+        if job["status"] != "queued":
+            continue
+        try:
+            instagram_job_queue.put_nowait((job["job_id"], job["url"]))
+        except asyncio.QueueFull:
+            job["status"] = "rejected"
+            rejected.append(job["job_id"])
+    if rejected:
+        await run_in_threadpool(
+            update_instagram_jobs, rejected,
+            status="rejected", error="ジョブキューが満杯です。時間をおいて再送してください", finished_at=time.time()
         )
+    return {"jobs": [{"job_id": job["job_id"], "url": job["url"], "status": job["status"]} for job in jobs]}
 
-        # Azure上の公開URL
-        uploaded_image_url = f"https://{blob_service_client.account_name}.blob.core.windows.net/{container_name}/{filename}"
+@app.get("/api/instagram-jobs/{job_id}")
+async def get_instagram_job(job_id: str):
+    job = await run_in_threadpool(load_instagram_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return job
 
-        # 投稿情報とアップロードした画像URLを返す
-        result = {
-            "image_url": uploaded_image_url,
-            "caption": post_data.caption,
-            "likes": post_data.likes,
-            "comments": post_data.comments,
+# ================================
+# 🎨 キャンペーン画像生成ジョブ
+# ================================
+# 生成には 10〜30 秒かかるため、ジョブを受け付けてすぐ返し、クライアントはポーリング（wait で長ポーリング）する。
+# 生成画像は期限付き URL のままにせず自前のコンテナ（既定は投稿画像と同じ公開コンテナ）へコピーし、
+# 同じプロンプトはハッシュで重複排除する。
+CAMPAIGN_IMAGE_CONTAINER = os.getenv("CAMPAIGN_IMAGE_CONTAINER", container_name)
+IMAGE_JOB_TTL = int(os.getenv("IMAGE_JOB_TTL", 60 * 60))  # 完了ジョブを保持する秒数
+IMAGE_JOB_MAX_WAIT = 60  # 長ポーリングの最大秒数
+IMAGE_JOB_POLL_INTERVAL = 0.5  # 長ポーリング中に DB を読み直す間隔（秒）
+IMAGE_JOB_STALE_AFTER = int(os.getenv("IMAGE_JOB_STALE_AFTER", 10 * 60))  # これより古い生成中ジョブは落ちたワーカーの残骸とみなす
+
+image_job_tasks = set()
+
+def image_prompt_hash(prompt: str) -> str:
+    normalized = {
+        "deployment": DALLE_DEPLOYMENT,
+        "prompt": " ".join(prompt.split()),
+        "params": DALLE_IMAGE_PARAMS,
+    }
+    return hashlib.sha256(json.dumps(normalized, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+def load_generated_image(prompt_hash: str):
+    db = SessionLocal()
+    try:
+        row = db.get(GeneratedImage, prompt_hash)
+        return {"image_url": row.image_url, "created_at": row.created_at} if row else None
+    finally:
+        db.close()
+
+def save_generated_image(prompt_hash: str, prompt: str, blob_name: str, image_url: str):
+    db = SessionLocal()
+    try:
+        db.merge(GeneratedImage(
+            prompt_hash=prompt_hash, prompt=prompt, blob_name=blob_name,
+            image_url=image_url, created_at=datetime.utcnow(),
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+def image_job_dict(job: ImageJob) -> dict:
+    data = {
+        "job_id": job.job_id, "prompt_hash": job.prompt_hash, "status": job.status,
+        "result": {"image_url": job.image_url} if job.image_url else None, "error": job.error,
+        "created_at": job.created_at, "finished_at": job.finished_at,
+    }
+    if job.cached:
+        data["cached"] = True
+    return data
+
+def load_image_job(job_id: str):
+    db = SessionLocal()
+    try:
+        job = db.get(ImageJob, job_id)
+        return image_job_dict(job) if job else None
+    finally:
+        db.close()
+
+def claim_image_job(prompt_hash: str):
+    # 新しいジョブを登録して (ジョブ, True) を返す。同じプロンプトが生成中ならそのジョブを (ジョブ, False) で返す
+    db = SessionLocal()
+    try:
+        now = time.time()
+        db.query(ImageJob).filter(ImageJob.finished_at < now - IMAGE_JOB_TTL).delete(synchronize_session=False)
+        db.query(ImageJob).filter(
+            ImageJob.active_hash == prompt_hash, ImageJob.created_at < now - IMAGE_JOB_STALE_AFTER
+        ).update({
+            "status": "error", "error": "生成が完了しないまま中断されました", "finished_at": now, "active_hash": None,
+        }, synchronize_session=False)
+        db.commit()
+        while True:
+            job = ImageJob(job_id=uuid.uuid4().hex, prompt_hash=prompt_hash, active_hash=prompt_hash,
+                           status="queued", created_at=now)
+            db.add(job)
+            try:
+                db.commit()
+                return image_job_dict(job), True
+            except IntegrityError:
+                db.rollback()
+            running = db.query(ImageJob).filter(ImageJob.active_hash == prompt_hash).first()
+            if running is not None:
+                return image_job_dict(running), False
+            # 確認までの間に先のジョブが終わった場合は登録し直す
+    finally:
+        db.close()
+
+def update_image_job(job_id: str, **fields):
+    db = SessionLocal()
+    try:
+        db.query(ImageJob).filter(ImageJob.job_id == job_id).update(fields, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+async def finish_image_job(job_id: str, **fields):
+    await run_in_threadpool(update_image_job, job_id, finished_at=time.time(), active_hash=None, **fields)
+
+async def generate_and_store_image(prompt: str, prompt_hash: str) -> str:
+    # 生成した画像を自前のコンテナへコピーして記録し、その URL を返す
+    source_url = await generate_dalle_image(prompt)
+    blob_name = f"campaign-images/{prompt_hash}.png"
+    try:
+        image_url = await stream_to_blob(source_url, CAMPAIGN_IMAGE_CONTAINER, blob_name, "image/png")
+    except Exception as e:
+        # 生成済みの画像を無駄にしないよう、コピーに失敗したら DALL·E の URL をそのまま返す（記録はしない）
+        print(f"⚠️ 生成画像のコピーに失敗しました: {e}")
+        return source_url
+    await run_in_threadpool(save_generated_image, prompt_hash, prompt, blob_name, image_url)
+    return image_url
+
+async def run_image_job(job_id: str, prompt: str, prompt_hash: str):
+    try:
+        await run_in_threadpool(update_image_job, job_id, status="running")
+        image_url = await generate_and_store_image(prompt, prompt_hash)
+        await finish_image_job(job_id, status="done", image_url=image_url)
+    except asyncio.CancelledError:
+        await finish_image_job(job_id, status="error", error="サーバー停止のため中断されました")
+        raise
+    except Exception as e:
+        print("❌ Image Generation Error:", str(e))
+        await finish_image_job(job_id, status="error", error=f"画像生成エラー: {str(e)}")
+
+async def cancel_image_jobs():
+    for task in list(image_job_tasks):
+        task.cancel()
+    await asyncio.gather(*image_job_tasks, return_exceptions=True)
+
+@app.post("/api/image-jobs", status_code=202, dependencies=[Depends(rate_limited("image"))])
+async def create_image_job(req: ImageRequest):
+    prompt_hash = image_prompt_hash(req.analysis_summary)
+
+    # 同じプロンプトが（どのワーカーでも）生成中ならそのジョブを返す
+    try:
+        job, created = await run_in_threadpool(claim_image_job, prompt_hash)
+    except Exception as e:
+        print("❌ Image Generation Error:", str(e))
+        return JSONResponse(status_code=500, content={"error": f"画像生成エラー: {str(e)}"})
+    if not created:
+        return job
+    job_id = job["job_id"]
+
+    # 生成済みなら課金せずに保存済みの画像を返す。確認している間に届いた同じプロンプトも、このジョブに相乗りさせる
+    try:
+        stored = await run_in_threadpool(load_generated_image, prompt_hash)
+    except asyncio.CancelledError:
+        await finish_image_job(job_id, status="error", error="リクエストが中断されました")
+        raise
+    except Exception as e:
+        print("❌ Image Generation Error:", str(e))
+        await finish_image_job(job_id, status="error", error=f"画像生成エラー: {str(e)}")
+        return JSONResponse(status_code=500, content={"error": f"画像生成エラー: {str(e)}"})
+    if stored:
+        await finish_image_job(job_id, status="done", image_url=stored["image_url"], cached=1)
+        return await run_in_threadpool(load_image_job, job_id)
+
+    task = asyncio.create_task(run_image_job(job_id, req.analysis_summary, prompt_hash))
+    image_job_tasks.add(task)
+    task.add_done_callback(image_job_tasks.discard)
+    return job
+
+@app.get("/api/image-jobs/{job_id}")
+async def get_image_job(job_id: str, wait: float = 0):
+    job = await run_in_threadpool(load_image_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    # wait 秒まで完了を待ってから返す（長ポーリング）。生成は別のワーカーで動いていることもあるので DB を読み直す
+    deadline = time.monotonic() + min(wait, IMAGE_JOB_MAX_WAIT)
+    while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+        await asyncio.sleep(min(IMAGE_JOB_POLL_INTERVAL, deadline - time.monotonic()))
+        job = await run_in_threadpool(load_image_job, job_id) or job
+    return job
+
+# ================================
+# 📊 キャンペーンレポート集計
+# ================================
+CAMPAIGN_REPORT_RANKING_SIZE = int(os.getenv("CAMPAIGN_REPORT_RANKING_SIZE", 10))
+
+def post_engagement(likes: int, comments: int, followers: int) -> float:
+    if not followers:
+        return 0.0
+    return ((likes or 0) + (comments or 0)) / followers * 100
+
+def apply_campaign_post(conn, campaign_id: int, post: dict, now: datetime):
+    # 投稿 1 件分の指標を campaign_posts に反映し、前回値との差分だけを投稿者ロールアップに足し込む
+    likes = post["likes"] or 0
+    comments = post["comments"] or 0
+    engagement = post_engagement(likes, comments, post["owner_followers"])
+    username = post["owner_username"] or ""
+
+    table = CampaignPost.__table__
+    key = and_(table.c.campaign_id == campaign_id, table.c.shortcode == post["shortcode"])
+    # 初回は指標 0 の行を作ってから行ロックを取る。別ワーカーが同じ投稿を同時に更新しても、
+    # 後から来た方は先の更新が commit されるまで待ってその値との差分を取るので、ロールアップが二重に増えない
+    created = conn.execute(
+        insert(table).prefix_with("IGNORE" if IS_MYSQL else "OR IGNORE").values(
+            campaign_id=campaign_id, shortcode=post["shortcode"], username=username,
+            likes=0, comments=0, engagement=0.0, created_at=now, updated_at=now,
+        )
+    ).rowcount
+    previous = conn.execute(
+        select(table.c.username, table.c.likes, table.c.comments, table.c.engagement).where(key).with_for_update()
+    ).one()
+    conn.execute(
+        table.update().where(key)
+        .values(username=username, likes=likes, comments=comments, engagement=engagement, updated_at=now)
+    )
+
+    if created or previous.username == username:
+        add_to_campaign_rollup(conn, campaign_id, username, now, {
+            "post_count": 1 if created else 0,
+            "likes": likes - (previous.likes or 0),
+            "comments": comments - (previous.comments or 0),
+            "engagement_sum": engagement - (previous.engagement or 0.0),
+        })
+    else:
+        # 投稿者がユーザー名を変えていたら、この投稿の分を旧名の行から新しい名前の行へ移す
+        add_to_campaign_rollup(conn, campaign_id, previous.username or "", now, {
+            "post_count": -1,
+            "likes": -(previous.likes or 0),
+            "comments": -(previous.comments or 0),
+            "engagement_sum": -(previous.engagement or 0.0),
+        })
+        add_to_campaign_rollup(conn, campaign_id, username, now, {
+            "post_count": 1, "likes": likes, "comments": comments, "engagement_sum": engagement,
+        })
+
+def add_to_campaign_rollup(conn, campaign_id: int, username: str, now: datetime, delta: dict):
+    rollup = CampaignUserRollup.__table__
+    conn.execute(upsert_statement(
+        rollup, {"campaign_id": campaign_id, "username": username, "updated_at": now, **delta}, ["campaign_id", "username"],
+        lambda new: {
+            "post_count": rollup.c.post_count + new.post_count,
+            "likes": rollup.c.likes + new.likes,
+            "comments": rollup.c.comments + new.comments,
+            "engagement_sum": rollup.c.engagement_sum + new.engagement_sum,
+            "updated_at": new.updated_at,
+        },
+    ))
+
+def register_campaign_post(campaign_id: int, post: dict):
+    with engine.begin() as conn:
+        apply_campaign_post(conn, campaign_id, post, datetime.utcnow())
+
+def refresh_campaign_posts(post: dict):
+    with engine.begin() as conn:
+        campaign_ids = conn.execute(
+            select(CampaignPost.campaign_id).where(CampaignPost.shortcode == post["shortcode"])
+        ).scalars().all()
+        now = datetime.utcnow()
+        for campaign_id in campaign_ids:
+            apply_campaign_post(conn, campaign_id, post, now)
+
+def build_campaign_report(campaign_id: int, ranking_size: int = CAMPAIGN_REPORT_RANKING_SIZE) -> dict:
+    # 集計済みのロールアップに対して順位・合計・人数をウィンドウ関数で 1 クエリで求める
+    rollup = CampaignUserRollup.__table__
+    engagement = (rollup.c.engagement_sum / func.nullif(rollup.c.post_count, 0)).label("engagement")
+    stmt = (
+        select(
+            rollup.c.username,
+            rollup.c.likes,
+            rollup.c.comments,
+            engagement,
+            func.row_number().over(order_by=(rollup.c.likes.desc(), rollup.c.username)).label("likes_rank"),
+            func.row_number().over(order_by=(rollup.c.comments.desc(), rollup.c.username)).label("comments_rank"),
+            func.row_number().over(order_by=(engagement.desc(), rollup.c.username)).label("engagement_rank"),
+        )
+        .where(rollup.c.campaign_id == campaign_id, rollup.c.post_count > 0)
+    )
+    with engine.connect() as conn:
+        rows = conn.execute(stmt).all()
+
+    def metric(name: str, digits: int = None) -> dict:
+        ranked = sorted((row for row in rows if getattr(row, f"{name}_rank") <= ranking_size),
+                        key=lambda row: getattr(row, f"{name}_rank"))
+        values = [float(getattr(row, name) or 0) for row in rows]
+        total = sum(values)
+        average = total / len(values) if values else 0
+        if digits is None:
+            return {
+                "ranking": [{"user": row.username, "value": int(getattr(row, name) or 0)} for row in ranked],
+                "total": int(total),
+                "average": int(round(average)),
+            }
+        return {
+            "ranking": [{"user": row.username, "value": round(float(getattr(row, name) or 0), digits)} for row in ranked],
+            "total": round(total, digits),
+            "average": round(average, digits),
         }
-        return result
 
+    return {
+        "likes": metric("likes"),
+        "comments": metric("comments"),
+        "engagement": metric("engagement", digits=2),
+    }
+
+@app.post("/api/campaigns/{campaign_id}/posts", dependencies=[Depends(rate_limited("instagram"))])
+async def add_campaign_post(campaign_id: int, post: PostURL):
+    try:
+        record, cached = await ingest_instagram_post_record(post.url)
+        if record["owner_followers"] is None and record["owner_username"]:
+            # 通常の取り込みではフォロワー数を取らないので、キャンペーンに登録するときに補う
+            followers = await run_in_threadpool(fetch_owner_followers, record["owner_username"])
+            if followers is not None:
+                await run_in_threadpool(save_owner_followers, record["shortcode"], followers)
+                record = {**record, "owner_followers": followers}
+        await run_in_threadpool(register_campaign_post, campaign_id, record)
+        return instagram_post_response(record, cached)
+    except InvalidPostURL as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except InstagramUnavailable as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
-        
+
+@app.get("/api/campaigns/{campaign_id}/report")
+async def campaign_report(campaign_id: int):
+    # レスポンスの形は /api/dummy-campaign-report と同じ
+    return await run_in_threadpool(build_campaign_report, campaign_id)
+
 # ================================
 # 📊 レポート生成API
 # ================================
@@ -553,57 +3413,248 @@ async def dummy_campaign_report():
 # ================================
 # 📊 フォロワーリスト取得API
 # ================================
-@app.post("/api/export-followers")
-async def export_followers(username: str):
+# 1 行ごとに Instagram へのプロフィール取得が走るので、既定は従来どおり少なめにする
+FOLLOWER_EXPORT_DEFAULT_LIMIT = int(os.getenv("FOLLOWER_EXPORT_DEFAULT_LIMIT", 30))
+FOLLOWER_EXPORT_MAX_LIMIT = int(os.getenv("FOLLOWER_EXPORT_MAX_LIMIT", 1000))
+FOLLOWER_FIELDS = ["username", "full_name", "bio", "followers", "followees", "is_private", "is_verified"]
+
+def encode_follower_cursor(frozen) -> str:
+    raw = json.dumps(frozen._asdict(), ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+class InvalidFollowerCursor(ValueError):
+    pass
+
+def decode_follower_cursor(cursor: str):
+    from instaloader.nodeiterator import FrozenNodeIterator
+
     try:
-        loader = Instaloader()
-        ig_username = os.getenv("INSTAGRAM_USERNAME")
-        ig_password = os.getenv("INSTAGRAM_PASSWORD")
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        return FrozenNodeIterator(**json.loads(raw))
+    except Exception:
+        raise InvalidFollowerCursor("cursor が不正です")
+
+def open_follower_iterator(slot: InstaloaderSlot, username: str, frozen=None):
+    from instaloader import Profile
+    from instaloader.exceptions import InvalidArgumentException
+
+    with trace_span("instaloader_profile"):
+        profile = Profile.from_username(slot.loader.context, username)
+    followers = profile.get_followers()
+    if frozen is not None:
+        # 前回のエクスポートの続きから再開する（別のユーザーのフォロワー一覧のカーソルなどは受け付けない）
+        try:
+            followers.thaw(frozen)
+        except InvalidArgumentException as e:
+            raise InvalidFollowerCursor(f"cursor がこのエクスポートと一致しません: {e}")
+    return followers
 
-        if not ig_username or not ig_password:
-            raise ValueError("INSTAGRAM_USERNAME または INSTAGRAM_PASSWORD が未設定です")
+def follower_row(follower) -> dict:
+    return {
+        "username": follower.username,
+        "full_name": follower.full_name,
+        "bio": follower.biography,
+        "followers": follower.followers,
+        "followees": follower.followees,
+        "is_private": follower.is_private,
+        "is_verified": follower.is_verified,
+    }
 
-        loader.login(ig_username, ig_password)
-        profile = Profile.from_username(loader.context, username)
-        followers = profile.get_followers()
-
-        results = []
-        for i, follower in enumerate(followers):
-            if i >= 30:
-                break
-            results.append({
-                "username": follower.username,
-                "full_name": follower.full_name,
-                "bio": follower.biography,
-                "followers": follower.followers,
-                "followees": follower.followees,
-                "is_private": follower.is_private,
-                "is_verified": follower.is_verified,
-            })
-
-        with tempfile.NamedTemporaryFile(delete=False, mode="w", suffix=".csv") as temp_file:
-            writer = csv.DictWriter(temp_file, fieldnames=results[0].keys())
+def iter_follower_export(slot: InstaloaderSlot, followers, limit: int, export_format: str):
+    # 同期ジェネレーター（StreamingResponse がスレッドプール上で回す）
+    # Instagram から 1 件取れるたびに 1 行ずつ送り出し、一覧をメモリに溜めない
+    # 貸し出されたコンテキストはストリーム終了時に返却する
+    # CSV はフォロワー行だけを出す。続きのカーソルやエラーは NDJSON の最終行でのみ返し、
+    # CSV で途中に失敗した場合は接続を切って、不完全なファイルだと分かるようにする
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FOLLOWER_FIELDS)
+
+    def flush() -> str:
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return value
+
+    next_cursor = None
+    count = 0
+    error = None
+    budget_exhausted = False
+    try:
+        if export_format == "csv":
             writer.writeheader()
-            writer.writerows(results)
-            csv_path = temp_file.name
+            yield flush()
 
-        return FileResponse(csv_path, media_type="text/csv", filename=f"{username}_followers.csv")
+        try:
+            for follower in followers:
+                if count >= limit:
+                    # 未出力の 1 件目を指す位置で凍結し、次回はここから再開できるようにする
+                    next_cursor = encode_follower_cursor(followers.freeze())
+                    break
+                row = follower_row(follower)  # フォロワーごとにプロフィール取得のリクエストが走る
+                if export_format == "csv":
+                    writer.writerow(row)
+                    yield flush()
+                else:
+                    yield json.dumps(row, ensure_ascii=False) + "\n"
+                count += 1
+        except InstagramBudgetExceeded as e:
+            # アカウントの 1 時間予算が尽きたらそこで止め、続きから再開できるカーソルを返す
+            # （ページ取得中に尽きた場合は、再開時に直前の 1 件がもう一度出力される）
+            print("⚠️ フォロワーエクスポート中断:", str(e))
+            budget_exhausted = True
+            next_cursor = encode_follower_cursor(followers.freeze())
+    except Exception as e:
+        # ヘッダー送信後なのでステータスは変えられない
+        error = e
+        print("❌ エラー:", str(e))
+        if export_format == "csv":
+            raise
+        yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+        return
+    finally:
+        instaloader_pool.release(slot, error)
+
+    if export_format == "csv":
+        if budget_exhausted:
+            # 予算切れで途中終了したことを CSV では表せないので、不完全なファイルとして接続を切る
+            raise InstagramBudgetExceeded("Instagram のリクエスト上限に達したためエクスポートを中断しました")
+    else:
+        yield json.dumps({"exported": count, "next_cursor": next_cursor, "budget_exhausted": budget_exhausted}) + "\n"
+
+@app.post("/api/export-followers", dependencies=[Depends(rate_limited("export"))])
+async def export_followers(username: str, format: str = "csv", limit: int = FOLLOWER_EXPORT_DEFAULT_LIMIT, cursor: Optional[str] = None):
+    if format not in ("csv", "ndjson"):
+        return JSONResponse(status_code=400, content={"error": "format は csv または ndjson を指定してください"})
+    limit = max(1, min(limit, FOLLOWER_EXPORT_MAX_LIMIT))
+
+    # カーソルは凍結したときのアカウントでしか再開できないので、同じアカウントのコンテキストを借りる
+    frozen = None
+    account = None
+    if cursor:
+        try:
+            frozen = decode_follower_cursor(cursor)
+        except InvalidFollowerCursor as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+        account = frozen.context_username
+        if account not in [name for name, _ in instagram_accounts()]:
+            return JSONResponse(status_code=400, content={"error": "cursor を発行した Instagram アカウントが設定されていません"})
 
+    try:
+        # ログイン済みコンテキストの貸出とプロフィール取得はストリーム開始前に済ませ、失敗はエラーレスポンスで返す
+        slot = await run_in_threadpool(instaloader_pool.acquire, True, INSTAGRAM_LEASE_TIMEOUT, account)
+    except InstagramUnavailable as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
     except Exception as e:
         print("❌ エラー:", str(e))
         return JSONResponse(status_code=500, content={"error": str(e)})
-        
-# ======================
-# ▶️ ローカル実行（開発用）
-# ======================
+
+    try:
+        followers = await run_in_threadpool(open_follower_iterator, slot, username, frozen)
+    except InvalidFollowerCursor as e:
+        instaloader_pool.release(slot)
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    except InstagramUnavailable as e:
+        instaloader_pool.release(slot, e)
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    except Exception as e:
+        instaloader_pool.release(slot, e)
         print("❌ エラー:", str(e))
         return JSONResponse(status_code=500, content={"error": str(e)})
+
+    if format == "csv":
+        media_type = "text/csv"
+        filename = f"{username}_followers.csv"
+    else:
+        media_type = "application/x-ndjson"
+        filename = f"{username}_followers.ndjson"
+
+    return TrackedStreamingResponse(
+        iter_follower_export(slot, followers, limit, format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
         
+# ================================
+# 🩺 起動ウォームアップ / レディネス
+# ================================
+dependency_status = {
+    name: {"ready": False, "error": None}
+    for name in ("database", "openai", "blob_storage", "instagram")
+}
+warm_up_task = None
+
+def ping_database():
+    # プールに 1 本目の接続（TLS ハンドシェイク済み）を用意しておく
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
+async def warm_openai():
+    await run_in_threadpool(importlib.import_module, "openai")
+    await run_in_threadpool(get_token_encoder)  # エンコーディングの読み込み（初回はダウンロード）
+    get_chat_client()
+    get_dalle_client()
+
+async def warm_blob_storage():
+    await run_in_threadpool(importlib.import_module, "azure.storage.blob.aio")
+    get_async_blob_service_client()
+
+async def warm_instagram():
+    await run_in_threadpool(instaloader_pool.load_sessions)
+
+WARM_UP_STEPS = {
+    "database": lambda: run_in_threadpool(ping_database),
+    "openai": warm_openai,
+    "blob_storage": warm_blob_storage,
+    "instagram": warm_instagram,
+}
+
+async def warm_dependency(name: str):
+    try:
+        await WARM_UP_STEPS[name]()
+        dependency_status[name] = {"ready": True, "error": None}
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        dependency_status[name] = {"ready": False, "error": str(e)}
+        print(f"⚠️ ウォームアップ失敗 ({name}):", str(e))
+
+async def warm_up_dependencies():
+    pending = [name for name, status in dependency_status.items() if not status["ready"]]
+    await asyncio.gather(*(warm_dependency(name) for name in pending))
+
+def start_warm_up():
+    global warm_up_task
+    if warm_up_task is None or warm_up_task.done():
+        warm_up_task = asyncio.create_task(warm_up_dependencies())
+
+@app.get("/api/ready")
+async def readiness():
+    ready = all(status["ready"] for status in dependency_status.values())
+    if not ready:
+        # 失敗した依存先はレディネス確認のたびに再試行する
+        start_warm_up()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "dependencies": dependency_status},
+    )
+
 # ======================
 # ▶️ ローカル実行（開発用）
 # ======================
+# python app.py          … 開発サーバー起動
+# python app.py migrate  … テーブル作成
+# python app.py serve    … 本番構成（gunicorn + uvicorn ワーカー、設定は gunicorn.conf.py）
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        migrate_database()
+        print("✅ テーブル作成完了")
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        conf = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py")
+        os.execvp("gunicorn", ["gunicorn", "-c", conf, "app:app"])
+
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
-    print(f"Starting FastAPI on port {PORT} with DB {MYSQL_DB_NAME}") #　追加✅　Github追加
+    print(f"Starting FastAPI on port {port} with DB {MYSQL_DB_NAME}") #　追加✅　Github追加
     uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,175 @@
+# ====================================
+# 🧪 ベンチマーク用のローカル代替サービス
+# ====================================
+# 有料の Azure リソースを使わずに app.py を計測するための偽物:
+#   - Azure OpenAI 互換サーバー（チャット補完 / ストリーミング / 画像生成、遅延とトークン数を調整可能）
+#   - Instagram 画像 CDN の代わりに画像バイト列を返すエンドポイント
+#   - メモリ上だけで動く Azure Blob Storage（Azurite 相当）のクライアント
+import asyncio
+import io
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+@dataclass
+class FakeUpstreamConfig:
+    chat_latency: float = 0.5  # 最初のトークンまでの秒数
+    chat_tokens: int = 200  # 応答のトークン数
+    token_interval: float = 0.005  # ストリーミング時のトークン間隔（秒）
+    image_latency: float = 2.0  # 画像生成の秒数
+    image_bytes: int = 200 * 1024  # ダウンロードされる画像のサイズ
+    real_images: bool = False  # True なら Pillow で本物の JPEG を返す（画像加工ステージも計測する）
+
+def create_fake_upstream(config: FakeUpstreamConfig) -> FastAPI:
+    fake = FastAPI()
+
+    def completion_id() -> str:
+        return f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    @fake.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        body = await request.json()
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+        created = int(time.time())
+
+        if body.get("stream"):
+            async def chunks():
+                await asyncio.sleep(config.chat_latency)
+                cid = completion_id()
+                for i in range(config.chat_tokens):
+                    chunk = {
+                        "id": cid, "object": "chat.completion.chunk", "created": created, "model": deployment,
+                        "choices": [{"index": 0, "delta": {"content": f"トークン{i} "}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    await asyncio.sleep(config.token_interval)
+                final = {
+                    "id": cid, "object": "chat.completion.chunk", "created": created, "model": deployment,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+                yield f"data: {json.dumps(final)}\n\n"
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage = {
+                        "id": cid, "object": "chat.completion.chunk", "created": created, "model": deployment, "choices": [],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": config.chat_tokens,
+                            "total_tokens": prompt_tokens + config.chat_tokens,
+                        },
+                    }
+                    yield f"data: {json.dumps(usage)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(chunks(), media_type="text/event-stream")
+
+        await asyncio.sleep(config.chat_latency + config.token_interval * config.chat_tokens)
+        return JSONResponse({
+            "id": completion_id(),
+            "object": "chat.completion",
+            "created": created,
+            "model": deployment,
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": " ".join(f"トークン{i}" for i in range(config.chat_tokens))},
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": config.chat_tokens,
+                "total_tokens": prompt_tokens + config.chat_tokens,
+            },
+        })
+
+    @fake.post("/openai/deployments/{deployment}/images/generations")
+    async def image_generations(deployment: str, request: Request):
+        await asyncio.sleep(config.image_latency)
+        base = str(request.base_url).rstrip("/")
+        return JSONResponse({
+            "created": int(time.time()),
+            "data": [{"url": f"{base}/images/generated-{uuid.uuid4().hex}.png", "revised_prompt": ""}],
+        })
+
+    noise = {}
+
+    def real_jpeg(name: str) -> bytes:
+        # 1080px 四方のノイズ画像（圧縮が効かないので実写に近いサイズになる）。名前はコメントに入れて内容を変える
+        from PIL import Image
+
+        if "image" not in noise:
+            noise["image"] = Image.frombytes("RGB", (1080, 1080), os.urandom(1080 * 1080 * 3))
+        buffer = io.BytesIO()
+        noise["image"].save(buffer, "JPEG", quality=85, comment=name.encode("utf-8"))
+        return buffer.getvalue()
+
+    @fake.get("/images/{name}")
+    async def image(name: str):
+        if config.real_images:
+            return Response(await asyncio.to_thread(real_jpeg, name), media_type="image/jpeg")
+        # 名前ごとに内容を変えて、内容ハッシュによる重複排除が効きすぎないようにする
+        header = b"\xff\xd8\xff\xe0" + name.encode("utf-8")
+        return Response(header + b"\0" * max(config.image_bytes - len(header), 0), media_type="image/jpeg")
+
+    return fake
+
+# ================================
+# 🗄 メモリ上の Blob Storage
+# ================================
+class FakeBlobClient:
+    def __init__(self, service: "FakeBlobServiceClient", container: str, blob: str):
+        self.service = service
+        self.container = container
+        self.blob_name = blob
+
+    @property
+    def url(self) -> str:
+        return f"https://{self.service.account_name}.blob.core.windows.net/{self.container}/{self.blob_name}"
+
+    async def upload_blob(self, data, **kwargs):
+        if isinstance(data, (bytes, bytearray)):
+            payload = bytes(data)
+        elif hasattr(data, "__aiter__"):
+            payload = b"".join([chunk async for chunk in data])
+        else:
+            payload = b"".join(data)
+        self.service.blobs[(self.container, self.blob_name)] = payload
+        self.service.uploads += 1
+        return {"etag": uuid.uuid4().hex}
+
+class FakeBlobServiceClient:
+    def __init__(self, account_name: str = "benchfake"):
+        self.account_name = account_name
+        self.blobs = {}
+        self.uploads = 0
+
+    def get_blob_client(self, container: str, blob: str) -> FakeBlobClient:
+        return FakeBlobClient(self, container, blob)
+
+    async def close(self):
+        pass
+
+# ================================
+# ▶️ スレッド上で uvicorn を起動する
+# ================================
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(asgi_app, port: int, timeout: float = 30) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while not server.started:
+        if time.monotonic() > deadline or not thread.is_alive():
+            raise RuntimeError(f"ポート {port} のサーバーが起動しませんでした")
+        time.sleep(0.05)
+    return server
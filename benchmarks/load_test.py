@@ -0,0 +1,218 @@
+# ====================================
+# 📈 負荷試験 / ベンチマーク
+# ====================================
+# 本物の FastAPI app を、ローカルの代替サービス（SQLite・メモリ上の Blob・偽 OpenAI サーバー）
+# に向けて起動し、各エンドポイントを指定の同時実行数で叩いて p50/p95/p99 と RPS を JSON で出力する。
+#
+#   python benchmarks/load_test.py --requests 200 --concurrency 20 --output result.json
+#   python benchmarks/load_test.py --baseline result.json --max-regression 0.2   # 劣化検知（終了コード 1）
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeBlobServiceClient, FakeUpstreamConfig, create_fake_upstream, free_port, start_server
+
+SCENARIOS = ["login", "register", "submit", "analyze", "fetch_instagram_post"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="app.py の負荷試験（外部サービスはすべてローカルの代替）")
+    parser.add_argument("--requests", type=int, default=100, help="シナリオごとのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="偽 OpenAI の初回トークンまでの秒数")
+    parser.add_argument("--openai-tokens", type=int, default=200)
+    parser.add_argument("--token-interval", type=float, default=0.005)
+    parser.add_argument("--instagram-latency", type=float, default=0.3, help="投稿メタデータ取得の疑似遅延（秒）")
+    parser.add_argument("--image-bytes", type=int, default=200 * 1024)
+    parser.add_argument("--real-images", action="store_true", help="本物の JPEG を返してサイズ別バリアント生成も計測する（Pillow が必要）")
+    parser.add_argument("--bcrypt-rounds", type=int, default=int(os.getenv("BCRYPT_ROUNDS", 12)))
+    parser.add_argument("--output", help="結果 JSON の保存先")
+    parser.add_argument("--baseline", help="比較対象の結果 JSON")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="p95 / RPS の許容劣化率")
+    return parser.parse_args()
+
+def configure_environment(args, workdir: str, upstream: str):
+    # app を import する前に設定する
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["DB_POOL_PRE_PING"] = "false"
+    os.environ["OPENAI_API_BASE"] = upstream
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["DALLE_API_BASE"] = upstream
+    os.environ["DALLE_API_KEY"] = "bench"
+    os.environ["AZURE_STORAGE_CONNECTION_STRING"] = "UseDevelopmentStorage=true"
+    os.environ["INSTAGRAM_SESSION_DIR"] = workdir
+    os.environ["INSTAGRAM_ACCOUNTS"] = ""
+    os.environ["INSTAGRAM_USERNAME"] = ""
+    os.environ["ANALYSIS_CACHE_ENABLED"] = "false"
+    os.environ["RATE_LIMIT_ENABLED"] = "false"  # 同一クライアントから大量に送るので制限を外す
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+
+def install_fakes(app_module, args, upstream: str) -> FakeBlobServiceClient:
+    blob = FakeBlobServiceClient()
+    app_module.async_blob_service_client = blob
+
+    def fake_fetch_post_metadata(shortcode: str, with_followers: bool = False) -> dict:
+        time.sleep(args.instagram_latency)  # instaloader と同じく同期でブロックする
+        return {
+            "image_url": f"{upstream}/images/{shortcode}.jpg",
+            "caption": f"bench caption {shortcode}",
+            "likes": 100,
+            "comments": 10,
+            "owner_username": "bench_owner",
+            "owner_followers": 1000 if with_followers else None,
+        }
+
+    app_module.fetch_post_metadata = fake_fetch_post_metadata
+    return blob
+
+def scenario_builders(run_id: str):
+    answers = {f"{section}-{question}": "Yes" for section in range(10) for question in range(20)}
+    return {
+        "login": lambda i: ("POST", "/api/login", {"email": f"bench-{run_id}@example.com", "password": "bench-password"}),
+        "register": lambda i: ("POST", "/api/register", {"name": "bench", "email": f"bench-{run_id}-{i}@example.com", "password": "bench-password"}),
+        "submit": lambda i: ("POST", "/submit", {"answers": answers, "user_id": 1, "store_id": 1}),
+        "analyze": lambda i: ("POST", "/api/analyze", {"prompt": f"店舗 {i} の経営課題を分析してください", "no_cache": True}),
+        "fetch_instagram_post": lambda i: ("POST", "/api/fetch-instagram-post", {"url": f"https://www.instagram.com/p/bench{run_id}{i}/"}),
+    }
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+async def run_scenario(client: httpx.AsyncClient, build, total: int, concurrency: int) -> dict:
+    counter = itertools.count()
+    latencies = []
+    statuses = Counter()
+
+    async def worker():
+        while True:
+            i = next(counter)
+            if i >= total:
+                return
+            method, path, body = build(i)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                statuses[str(response.status_code)] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status.startswith("2"))
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        "error_rate": round(1 - ok / total, 4) if total else 0.0,
+        "statuses": dict(statuses),
+    }
+
+async def run(args, base_url: str, scenarios: list) -> dict:
+    run_id = str(int(time.time()))
+    builders = scenario_builders(run_id)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = {}
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        if "login" in scenarios:
+            await client.post("/api/register", json={"name": "bench", "email": f"bench-{run_id}@example.com", "password": "bench-password"})
+        for name in scenarios:
+            results[name] = await run_scenario(client, builders[name], args.requests, args.concurrency)
+            print(f"✅ {name}: {results[name]['rps']} req/s, p95 {results[name]['p95_ms']} ms", file=sys.stderr)
+    return results
+
+def compare_with_baseline(results: dict, baseline: dict, max_regression: float) -> list:
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} ms -> {current['p95_ms']} ms")
+        if previous["rps"] and current["rps"] < previous["rps"] * (1 - max_regression):
+            regressions.append(f"{name}: rps {previous['rps']} -> {current['rps']}")
+    return regressions
+
+def main():
+    args = parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"不明なシナリオ: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="richconnections-bench-")
+    upstream_config = FakeUpstreamConfig(
+        chat_latency=args.openai_latency,
+        chat_tokens=args.openai_tokens,
+        token_interval=args.token_interval,
+        image_bytes=args.image_bytes,
+        real_images=args.real_images,
+    )
+    upstream_port = free_port()
+    upstream = f"http://127.0.0.1:{upstream_port}"
+    start_server(create_fake_upstream(upstream_config), upstream_port)
+
+    configure_environment(args, workdir, upstream)
+    import app as app_module
+
+    app_module.migrate_database()
+    blob = install_fakes(app_module, args, upstream)
+
+    app_port = free_port()
+    server = start_server(app_module.app, app_port)
+    try:
+        results = asyncio.run(run(args, f"http://127.0.0.1:{app_port}", scenarios))
+    finally:
+        server.should_exit = True
+
+    report = {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "openai_latency": args.openai_latency,
+            "openai_tokens": args.openai_tokens,
+            "instagram_latency": args.instagram_latency,
+            "real_images": args.real_images,
+            "bcrypt_rounds": args.bcrypt_rounds,
+            "cpu_count": os.cpu_count(),
+        },
+        "scenarios": results,
+        "blob_uploads": blob.uploads,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.max_regression)
+        if regressions:
+            print("❌ 性能劣化を検出しました:\n" + "\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
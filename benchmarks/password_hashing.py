@@ -0,0 +1,63 @@
+# ====================================
+# 🔐 bcrypt ログイン処理ベンチマーク
+# ====================================
+# app.py と同じ設定（BCRYPT_ROUNDS）で verify をプロセスプール上に流し、
+# ログイン/秒 とコアあたりのログイン/秒を表示する。
+#
+#   python benchmarks/password_hashing.py --logins 200 --rounds 12
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+def make_context(rounds: int) -> CryptContext:
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+def _verify(args):
+    rounds, password, hashed = args
+    return make_context(rounds).verify(password, hashed)
+
+def run(logins: int, rounds: int, workers: int) -> dict:
+    password = "benchmark-password"
+    hashed = make_context(rounds).hash(password)
+    jobs = [(rounds, password, hashed)] * logins
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_verify, jobs[:workers]))  # ワーカー起動分をウォームアップ
+        started = time.perf_counter()
+        results = list(executor.map(_verify, jobs))
+        elapsed = time.perf_counter() - started
+
+    assert all(results)
+    logins_per_sec = logins / elapsed
+    return {
+        "rounds": rounds,
+        "workers": workers,
+        "logins": logins,
+        "seconds": round(elapsed, 3),
+        "logins_per_sec": round(logins_per_sec, 2),
+        "logins_per_sec_per_core": round(logins_per_sec / workers, 2),
+        "ms_per_login": round(elapsed / logins * 1000 * workers, 2),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bcrypt ログインのスループット計測")
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=int(os.getenv("BCRYPT_ROUNDS", 12)))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    # 1 コアと全ワーカーの両方を計測して、コア数に対するスケールを確認する
+    reports = [run(args.logins, args.rounds, 1)]
+    if args.workers > 1:
+        reports.append(run(args.logins, args.rounds, args.workers))
+    print(json.dumps(reports, indent=2))
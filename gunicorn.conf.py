@@ -0,0 +1,86 @@
+# ====================================
+# 🚀 本番用 gunicorn 設定（uvicorn ワーカー）
+# ====================================
+# App Service のスタートアップコマンド:
+#   gunicorn app:app          … カレントディレクトリの gunicorn.conf.py が自動で読まれる
+#   python app.py serve       … 同じ設定で起動する
+#
+# ワーカー 1 つが 1 コアを使い切る（非同期 I/O + 重い処理は専用 Executor）ので、ワーカー数はコア数に合わせ、
+# MySQL の接続上限（DB_CONNECTION_BUDGET）を超えないように抑える。
+import importlib
+import os
+
+def available_cores() -> int:
+    # コンテナに割り当てられたコア数（取れなければ OS 全体）
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def worker_count(cores: int) -> int:
+    if os.getenv("WEB_CONCURRENCY"):
+        return max(1, int(os.getenv("WEB_CONCURRENCY")))
+    workers = cores
+    # ワーカーごとに最大 pool_size + max_overflow 本の接続を張る（既定値は app.py と合わせる）
+    budget = int(os.getenv("DB_CONNECTION_BUDGET", 0))  # このインスタンスが使ってよい MySQL 接続数（0 は制限なし）
+    per_worker = int(os.getenv("DB_POOL_SIZE", 5)) + int(os.getenv("DB_MAX_OVERFLOW", 10))
+    if budget:
+        workers = min(workers, budget // per_worker)
+    return max(1, workers)
+
+CORES = available_cores()
+STREAM_DRAIN_SECONDS = int(os.getenv("STREAM_DRAIN_SECONDS", 120))  # 終了時に実行中のストリームを待つ秒数
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8000)}"
+workers = worker_count(CORES)
+
+# パスワードハッシュ・画像加工のプロセスプールは、ワーカー全体でコア数を超えないように分ける（app の import 前に設定）
+os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(1, CORES // workers)))
+os.environ.setdefault("IMAGE_PROCESS_WORKERS", str(max(1, CORES // 2 // workers)))
+
+# uvicorn ワーカーは uvloop / httptools がインストールされていれば自動で使う（uvicorn[standard]）
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# keep-alive は前段の Azure ロードバランサーのアイドルタイムアウト（約 4 分）より長くし、
+# 閉じた接続にリクエストが送られて 502 になるのを防ぐ
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 245))
+# uvicorn ワーカーの timeout はリクエスト時間ではなくイベントループの死活監視。LLM の長い応答では切れない
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+# SIGTERM を受けたワーカーは新規接続を止め、実行中のリクエスト（SSE・NDJSON を含む）が終わるまでこの秒数待つ
+graceful_timeout = STREAM_DRAIN_SECONDS
+backlog = int(os.getenv("GUNICORN_BACKLOG", 2048))
+
+# マスターで app を 1 回だけ import し、ワーカーは fork でコピーオンライトに共有する（import エラーも起動時に分かる）
+preload_app = True
+accesslog = os.getenv("GUNICORN_ACCESSLOG", "-")
+errorlog = "-"
+
+def on_starting(server):
+    # ワーカーを起動する前にマスターで 1 回だけスキーマを最新にする（テーブル・列・インデックス・一意制約の追加）。
+    # 新しいテーブルを読むエンドポイントがデプロイ直後に 500 にならないようにする。失敗したら起動しない
+    if os.getenv("MIGRATE_ON_START", "true").lower() != "true":
+        server.log.info("⏭ MIGRATE_ON_START=false のためマイグレーションを省略します")
+        return
+    import app as application
+
+    application.migrate_database()
+    server.log.info("✅ マイグレーション完了")
+
+def when_ready(server):
+    # fork 前に重いライブラリとトークナイザーを読み込んでおき、各ワーカーの初回リクエストを軽くする。
+    # ソケットやイベントループを持つクライアントはワーカーごとに lifespan のウォームアップで作る
+    import app as application
+
+    for module in ("openai", "instaloader", "azure.storage.blob.aio"):
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            server.log.warning(f"⚠️ 事前 import 失敗 ({module}): {e}")
+    application.get_token_encoder()
+    server.log.info(f"✅ ワーカー {workers} 個で起動します（コア {CORES}）")
+
+def post_fork(server, worker):
+    # マスターから引き継いだ接続を子プロセスで使わない
+    import app as application
+
+    application.engine.dispose(close=False)